@@ -1,12 +1,21 @@
+import argparse
 import configparser
 import coloredlogs
+import inspect
 import logging
 import os
+import queue
 import sys
-import spice_api as spice
-from guessit import guessit
-from plexapi.myplex import MyPlexAccount
-from plexapi.server import PlexServer
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from matching import MalListIndex, count_containing, normalize_title, parse_guid, title_key
+from sync_state import SyncJournal, SyncState
+from watch_progress import EpisodeTable, calculate_watched
+
+# plexapi, spice_api and guessit are imported where they are used, importing
+# this module does not load them, read settings or authenticate
 
 
 # Logger
@@ -16,6 +25,21 @@ coloredlogs.install(fmt='%(asctime)s %(message)s', logger=logger)
 # Enable this if you want to also log all messages coming from imported libraries
 # coloredlogs.install(level='DEBUG')
 
+# Log messages of shows processed by workers are held back per show
+log_buffer = threading.local()
+
+
+class BufferedLogFilter(logging.Filter):
+    def filter(self, record):
+        records = getattr(log_buffer, 'records', None)
+        if records is None:
+            return True
+        records.append(record)
+        return False
+
+
+logger.addFilter(BufferedLogFilter())
+
 
 def read_settings(file):
     # File exists
@@ -28,28 +52,41 @@ def read_settings(file):
     return settings
 
 
-def plex_authenticate():
+def plex_authenticate(plex_settings, session=None):
+    from plexapi.myplex import MyPlexAccount
+    from plexapi.server import PlexServer
     method = plex_settings['authentication_method'].lower()
     # Direct connection
     if method == 'direct':
         base_url = plex_settings['base_url']
         token = plex_settings['token']
-        plex = PlexServer(base_url, token)
+        plex = PlexServer(base_url, token, session=session)
     # Myplex connection
     elif method == 'myplex':
         plex_server = plex_settings['server']
         plex_user = plex_settings['myplex_user']
         plex_password = plex_settings['myplex_password']
-        account = MyPlexAccount(plex_user, plex_password)
+        account = MyPlexAccount(plex_user, plex_password, session=session)
         plex = account.resource(plex_server).connect()
+        # connect() tries the server addresses with sessions of its own
+        if session is not None:
+            plex._session = session
     else:
         logger.critical(
             '[PLEX] Failed to authenticate due to invalid settings or authentication info, exiting...')
         sys.exit()
+    # Watched states are per user, managed users connect with a token of
+    # their own
+    managed_user = plex_settings.get('managed_user', fallback='')
+    if managed_user:
+        account = MyPlexAccount(token=plex._token, session=session)
+        token = account.user(managed_user).get_token(plex.machineIdentifier)
+        plex = PlexServer(plex._baseurl, token, session=session)
     return plex
 
 
-def mal_authenticate():
+def mal_authenticate(mal_settings):
+    import spice_api as spice
     user = mal_settings['username']
     password = mal_settings['password']
     mal = spice.init_auth(user, password)
@@ -61,48 +98,434 @@ def mal_authenticate():
 
 
 settings_file = 'settings.ini'
+profile_sections = ('PLEX', 'MAL', 'SYNC')
+
+
+def profile_file(file, name):
+    # File of a profile next to the file of the base settings,
+    # e.g. PlexMALSync-alice.db
+    root, extension = os.path.splitext(file)
+    return '{}-{}{}'.format(root, name, extension)
+
+
+def get_profiles(settings):
+    # Profile names in the order of their [MAL <name>] sections
+    return [section[4:].strip() for section in settings.sections()
+            if section.startswith('MAL ') and section[4:].strip()]
+
+
+def profile_settings(settings, name):
+    """
+    profile_settings: settings of the profile syncing the MAL account of [MAL <name>], the keys of the
+    [PLEX <name>], [MAL <name>] and [SYNC <name>] sections override those of [PLEX], [MAL] and [SYNC].
+    the sync state and metrics are kept in files of the profile, MAL searches, parsed titles and the
+    anime database in the [SYNC] state file shared by all profiles.
+    """
+    profile = configparser.ConfigParser()
+    for section in profile_sections:
+        profile.add_section(section)
+        if settings.has_section(section):
+            profile[section].update(settings.items(section, raw=True))
+    sync = profile['SYNC']
+    state_file = sync.get('state_file', fallback='PlexMALSync.db')
+    sync['cache_file'] = sync.get('cache_file', fallback=state_file)
+    sync['state_file'] = profile_file(state_file, name)
+    if sync.get('metrics_file', fallback=''):
+        sync['metrics_file'] = profile_file(sync['metrics_file'], name)
+    for section in profile_sections:
+        override = '{} {}'.format(section, name)
+        if settings.has_section(override):
+            profile[section].update(settings.items(override, raw=True))
+    return profile
+
+
+class SyncContext:
+    """
+    SyncContext: settings and clients used by a sync.
+    Plex and MAL are authenticated and the MAL cache, list snapshot and write queue are opened
+    when first used, so creating a context does not connect to anything. each is created once under
+    the context lock, workers of process_shows() asking at the same time get the same one.
+    """
+
+    def __init__(self, settings, name=None, shared=None):
+        from metrics import Metrics
+        self.settings = settings
+        for section in profile_sections:
+            if not settings.has_section(section):
+                settings.add_section(section)
+        self.plex_settings = settings['PLEX']
+        self.mal_settings = settings['MAL']
+        self.sync_settings = settings['SYNC']
+        self.state_file = self.sync_settings.get('state_file', fallback='PlexMALSync.db')
+        # MAL searches, parsed titles and the anime database, the same file
+        # for all profiles
+        self.cache_file = self.sync_settings.get('cache_file', fallback=self.state_file)
+
+        # Profile name and the context of another profile whose caches are
+        # used instead of opening them again
+        self.name = name
+        self.shared = shared
+
+        # Concurrency
+        self.workers = self.sync_settings.getint('workers', fallback=1)
+        self.connections = {
+            'plex': self.sync_settings.getint('plex_connections', fallback=self.workers),
+            'mal': self.sync_settings.getint('mal_connections', fallback=self.workers)}
+        self.host_limits = {
+            host: threading.BoundedSemaphore(connections)
+            for host, connections in self.connections.items()}
+
+        # Titles not matching exactly are matched to the MAL list and cached
+        # MAL entries at this trigram similarity before searching MAL
+        self.fuzzy_threshold = self.sync_settings.getfloat('fuzzy_threshold', fallback=0.85)
+
+        # MAL credentials are verified when first used, scripts/scrobble.py
+        # leaves that to MAL answering its list update
+        self.verify_credentials = True
+
+        # Per stage timing, requests, cache hits and retries, logged at the
+        # end of a sync
+        self.metrics = Metrics({'profile': name} if name else None)
+
+        # Clients are created when first used, possibly by several workers
+        # at the same time
+        self.lock = threading.RLock()
+        self._plex = None
+        self._mal_session = None
+        self._mal_credentials = None
+        self._mal_cache = None
+        self._mal_snapshot = None
+        self._mal_writes = None
+        self._parsed_titles = None
+        self._anime_db = None
+        self._spice_requests = None
+
+    @classmethod
+    def from_file(cls, file=settings_file, profile=None):
+        settings = read_settings(file)
+        if profile is None:
+            return cls(settings)
+        if profile not in get_profiles(settings):
+            logger.critical('[CONFIG] Profile not found: {}'.format(profile))
+            sys.exit()
+        return cls(profile_settings(settings, profile), profile)
 
-# Settings
-settings = read_settings(settings_file)
-plex_settings = settings['PLEX']
-mal_settings = settings['MAL']
+    def create_session(self, settings, host):
+        # One pooled session per server, counting its requests
+        from sessions import create_session
+        session = create_session(
+            settings.getint('pool_size', fallback=max(self.connections[host], 1)),
+            settings.getfloat('timeout', fallback=30),
+            settings.getboolean('keep_alive', fallback=True))
+        session.hooks['response'].append(self.metrics.response_hook(host))
+        return session
 
-# Authenticate
-plex = plex_authenticate()
-mal_credentials = mal_authenticate()
+    @property
+    def plex(self):
+        with self.lock:
+            if self._plex is None:
+                self._plex = plex_authenticate(
+                    self.plex_settings, self.create_session(self.plex_settings, 'plex'))
+        return self._plex
 
+    @property
+    def mal_session(self):
+        with self.lock:
+            if self._mal_session is None:
+                self._mal_session = self.create_session(self.mal_settings, 'mal')
+        return self._mal_session
 
-def get_anime_shows():
+    @property
+    def mal_credentials(self):
+        with self.lock:
+            if self._mal_credentials is None:
+                self.install_spice_requests()
+                if self.verify_credentials:
+                    self._mal_credentials = mal_authenticate(self.mal_settings)
+                else:
+                    self._mal_credentials = (
+                        self.mal_settings['username'].strip(), self.mal_settings['password'].strip())
+        return self._mal_credentials
+
+    def install_spice_requests(self):
+        # spice_api calls requests.get itself, it is given the MAL session once.
+        # Profiles share the session of the context whose caches they share,
+        # the one sending the searches
+        if self.shared is not None:
+            return self.shared.install_spice_requests()
+        with self.lock:
+            if self._spice_requests is None:
+                import spice_api as spice
+                from sessions import SessionRequests
+                self._spice_requests = SessionRequests(self.mal_session)
+                spice.spice.requests = spice.helpers.requests = self._spice_requests
+
+    @property
+    def mal_cache(self):
+        # MAL search results cache, TTLs are configured in hours
+        with self.lock:
+            if self._mal_cache is None:
+                from mal_cache import MalCache
+                if self.shared is not None:
+                    self._mal_cache = self.shared.mal_cache
+                else:
+                    self._mal_cache = MalCache(
+                        self.cache_file,
+                        self.mal_credentials,
+                        self.mal_settings.getfloat('cache_ttl', fallback=720) * 3600,
+                        self.mal_settings.getfloat('cache_ttl_airing', fallback=24) * 3600,
+                        self.mal_settings.getfloat('cache_ttl_not_found', fallback=24) * 3600,
+                        self.mal_settings.getfloat('read_rate', fallback=0),
+                        self.mal_settings.getint('read_burst', fallback=10))
+                self.metrics.watch(
+                    self._mal_cache, cache_hits='hits', cache_misses='misses', similar_hits='similar_hits')
+        return self._mal_cache
+
+    @property
+    def mal_snapshot(self):
+        # Last retrieved MAL list, used by scripts/scrobble.py
+        with self.lock:
+            if self._mal_snapshot is None:
+                from mal_cache import MalListSnapshot
+                if self.shared is not None:
+                    self._mal_snapshot = self.shared.mal_snapshot
+                else:
+                    self._mal_snapshot = MalListSnapshot(self.cache_file)
+        return self._mal_snapshot
+
+    @property
+    def mal_writes(self):
+        # MAL list writes are queued, coalesced and sent rate limited at the
+        # end
+        with self.lock:
+            if self._mal_writes is None:
+                from mal_writes import MalWriteQueue
+                self._mal_writes = MalWriteQueue(
+                    self.mal_credentials,
+                    self.mal_settings.getfloat('write_rate', fallback=1),
+                    self.mal_settings.getint('write_burst', fallback=5),
+                    self.mal_settings.getint('write_retries', fallback=3),
+                    self.mal_session,
+                    self.connections['mal'])
+                self.metrics.watch(self._mal_writes, retries='retried')
+        return self._mal_writes
+
+    @property
+    def parsed_titles(self):
+        # guessit results of Plex titles, kept between runs
+        with self.lock:
+            if self._parsed_titles is None:
+                from matching import ParsedTitles
+                if self.shared is not None:
+                    self._parsed_titles = self.shared.parsed_titles
+                else:
+                    self._parsed_titles = ParsedTitles(self.cache_file)
+                self.metrics.watch(self._parsed_titles, guessit_calls='misses')
+        return self._parsed_titles
+
+    @property
+    def anime_db(self):
+        # Local anime metadata imported with --import-anime-db, empty until then
+        with self.lock:
+            if self._anime_db is None:
+                from anime_db import AnimeDatabase
+                if self.shared is not None:
+                    self._anime_db = self.shared.anime_db
+                else:
+                    self._anime_db = AnimeDatabase(self.cache_file)
+        return self._anime_db
+
+    def close(self):
+        # Shared caches are closed by their own context
+        if self.shared is not None:
+            return
+        for store in (self._mal_cache, self._mal_snapshot, self._parsed_titles, self._anime_db):
+            if store is not None:
+                store.close()
+
+
+def process_shows(context, func, shows, host):
+    """
+    process_shows: call func for every show with up to [SYNC] workers threads, limited per host.
+    results and log messages are returned in the order of shows so output is the same as a sequential run.
+    """
+    workers = context.workers
+    if workers <= 1 or len(shows) <= 1:
+        return [func(show) for show in shows]
+
+    def run(show):
+        log_buffer.records = list()
+        try:
+            with context.host_limits[host]:
+                return func(show), None, log_buffer.records
+        except BaseException as e:
+            return None, e, log_buffer.records
+        finally:
+            log_buffer.records = None
+
+    results = list()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for result, error, records in executor.map(run, shows):
+            for record in records:
+                logger.handle(record)
+            if error is not None:
+                raise error
+            results.append(result)
+    return results
+
+
+def get_anime_shows(context):
     logger.info('[PLEX] Retrieving anime shows...')
-    section = plex_settings['anime_section']
-    shows = plex.library.section(section).search()
+    section = context.plex_settings['anime_section']
+    shows = context.plex.library.section(section).search()
     logger.info(
         '[PLEX] Retrieving of {} anime shows completed'.format(
             len(shows)))
     return shows
 
 
-def get_plex_watched_shows(shows):
-    logger.info('[PLEX] Retrieving watch count for shows...')
-    watched = dict()
-    for show in shows:
-        season_watched = 1
-        episodes_watched = 0
-        for episode in show.episodes():
+def get_plex_episodes(context, filters='', state=None, columns=False):
+    """
+    get_plex_episodes: retrieve all episodes of the anime section in bulk and group them by show.
+    episodes are requested in pages of page_size items instead of one request per show.
+    returns a dict of show rating key => list of (season, episode, watched) tuples, or an EpisodeTable
+    with columns.
+    """
+    from plexapi import utils
+    logger.info('[PLEX] Retrieving episodes in bulk...')
+    section = context.plex.library.section(context.plex_settings['anime_section'])
+    page_size = context.plex_settings.getint('page_size', fallback=1000)
+    episodes = EpisodeTable() if columns else defaultdict(list)
+    episode_count = 0
+    key = '/library/sections/{}/all?type={}{}'.format(section.key, utils.searchType('episode'), filters)
+    for page in fetch_pages(section, key, page_size):
+        for episode in page:
             try:
-                # If not season defined, season 1
-                season = 1 if not episode.seasonNumber else episode.seasonNumber
-                n_episode = episode.index
-                if episode.isWatched and n_episode:
-                    if (n_episode > episodes_watched and season ==
-                            season_watched) or (season > season_watched):
-                        season_watched = season
-                        episodes_watched = n_episode
-                    else:
-                        episodes_watched = 0
+                # Keep the Plex season index for ordering, specials (season
+                # 0) come first just like with show.episodes()
+                order = (utils.cast(int, episode.parentIndex) or 0, episode.index or 0)
+                if columns:
+                    episodes.append(
+                        str(episode.grandparentRatingKey), order[0], *get_episode_progress(episode, bulk=True))
+                else:
+                    episodes[str(episode.grandparentRatingKey)].append(
+                        (order, get_episode_progress(episode, bulk=True)))
+                if state is not None:
+                    state.update_watermark(get_episode_timestamp(episode))
             except BaseException:
                 logger.error('Error during lookup_result processing')
-                pass
+        episode_count += len(page)
+
+    # Order like show.episodes() does as watch count calculation depends on it
+    if not columns:
+        for key, show_episodes in episodes.items():
+            show_episodes.sort(key=lambda x: x[0])
+            episodes[key] = [x[1] for x in show_episodes]
+    logger.info(
+        '[PLEX] Retrieving of {} episodes completed'.format(episode_count))
+    return episodes
+
+
+def fetch_pages(section, key, page_size):
+    # plexapi 4 requests the pages of fetchItems() itself, paging in the key
+    # would return the same page for every one of them. Older versions
+    # return the single page the key asks for
+    if 'container_size' in inspect.signature(section.fetchItems).parameters:
+        yield section.fetchItems(key, container_size=page_size)
+        return
+    container_start = 0
+    while True:
+        page = section.fetchItems('{}&X-Plex-Container-Start={}&X-Plex-Container-Size={}'.format(
+            key, container_start, page_size))
+        yield page
+        if len(page) < page_size:
+            break
+        container_start += page_size
+
+
+def get_changed_show_keys(context, state):
+    # Only episodes viewed or updated after the last successful sync
+    changed = set()
+    for field in ('lastViewedAt', 'updatedAt'):
+        changed.update(get_plex_episodes(
+            context, '&{}>>={}'.format(field, state.watermark), state).keys())
+    logger.info(
+        '[PLEX] Found {} shows changed since last sync'.format(len(changed)))
+    return changed
+
+
+def get_episode_timestamp(episode):
+    # Read the dates from __dict__, plexapi reloads a partial episode on
+    # access of an attribute that is None (e.g. lastViewedAt of an unwatched
+    # episode)
+    dates = [episode.__dict__.get(field) for field in ('lastViewedAt', 'updatedAt')]
+    dates = [date for date in dates if date]
+    return int(max(dates).timestamp()) if dates else None
+
+
+def get_episode_progress(episode, bulk=False):
+    from plexapi import utils
+    # Bulk listings include the season index, avoid a season lookup per
+    # episode
+    season = utils.cast(int, episode.parentIndex) if bulk and episode.parentIndex \
+        else episode.seasonNumber
+    # If not season defined, season 1
+    season = 1 if not season else season
+    return season, episode.index, episode.isWatched
+
+
+def get_show_episodes(show):
+    episodes = list()
+    for episode in show.episodes():
+        try:
+            episodes.append(get_episode_progress(episode))
+        except BaseException:
+            logger.error('Error during lookup_result processing')
+    return episodes
+
+
+def get_plex_watched_shows(context, shows, state=None, full=True):
+    logger.info('[PLEX] Retrieving watch count for shows...')
+    incremental = not full and state is not None and state.watermark is not None
+    episodes = None
+    changed = set()
+    try:
+        if incremental:
+            changed = get_changed_show_keys(context, state)
+        else:
+            # With NumPy the episodes of all shows are calculated at once
+            episodes = get_plex_episodes(
+                context, state=state, columns=EpisodeTable.vectorized())
+    except BaseException:
+        # Fall back to one request per show
+        logger.error(
+            '[PLEX] Bulk episode retrieval failed, retrieving episodes per show')
+        incremental = False
+
+    def is_cached(show):
+        key = str(show.ratingKey)
+        return incremental and key not in changed and state.get_show(key) is not None
+
+    if episodes is None:
+        # Shows without cached or bulk retrieved episodes are requested per show
+        pending = [show for show in shows if not is_cached(show)]
+        episodes = dict(zip(
+            [str(show.ratingKey) for show in pending],
+            process_shows(context, get_show_episodes, pending, 'plex')))
+    if isinstance(episodes, EpisodeTable):
+        progress = episodes.calculate_watched()
+    else:
+        progress = {key: calculate_watched(show_episodes) for key, show_episodes in episodes.items()}
+
+    watched = dict()
+    for show in shows:
+        key = str(show.ratingKey)
+        if is_cached(show):
+            episodes_watched, season_watched = state.get_show(key)
+        else:
+            episodes_watched, season_watched = progress.get(key, (0, 1))
+            if state is not None:
+                state.set_show(key, show.title, (episodes_watched, season_watched))
         if episodes_watched > 0:
             watched[show] = (episodes_watched, season_watched)
             logger.info(
@@ -112,15 +535,16 @@ def get_plex_watched_shows(shows):
     return watched
 
 
-def get_mal_list():
+def get_mal_list(context):
+    from mal_cache import fetch_mal_list
     logger.info('[MAL] Retrieving list...')
-    user = mal_settings['username']
-    mal_list = spice.get_list(
-        spice.get_medium('anime'),
-        user,
-        mal_credentials).get_mediums()
+    user = context.mal_settings['username']
+    # Stop on wrong credentials before syncing, reading the list needs none
+    context.mal_credentials
+    mal_list = fetch_mal_list(context.mal_session, user)
     items = len(mal_list) if mal_list else 0
     logger.info('[MAL] Found {} shows on list'.format(items))
+    context.mal_snapshot.save(user, mal_list)
     return mal_list
 
 
@@ -129,42 +553,23 @@ def match_seasons_on_mal_list(mal_list):
     mal_list_seasoned = list()
     # type 1 indicates TV.
 
-    def is_tv_show(show): return show.raw_data.contents[3].contents[0] == '1'
-
-    def show_date(show): return show.raw_data.contents[7].contents[0] \
-        if show.raw_data.contents[7].contents[0] != '0000-00-00' else '9999-99-99'
-    # Filter tv shows
-    tv_shows = list(filter(is_tv_show, mal_list))
-
-    for show in tv_shows:
-        matched_list = list()
-        # Later seasons have longer names, e.g. "original_name 2/Final/Second Stage/!!"
-        # Only the original season should have a list properly populated
-        for matched_shows in tv_shows:
-            if show.title.lower() in matched_shows.title.lower():
-                match = (show, show_date(show))
-                matched_list.append(match)
-        matched_list.sort(key=lambda x: x[1])
+    def is_tv_show(show): return show.anime_type == '1'
+    # Filter tv shows, titles are extracted once instead of per comparison
+    tv_shows = [(show, show.title) for show in mal_list if is_tv_show(show)]
+    tv_titles = [normalize_title(title) for show, title in tv_shows]
 
-        try:
-            original_name = [
-                x[0].title for x in matched_list if x[1] != '9999-99-99']
-            # Can't do miracles if it's all empty
-            original_name_treated = original_name[0] if original_name else matched_list[0][0].title
-        except BaseException:
-            logger.error(
-                'Error during matching season retrieval for show: {}'.format(
-                    show.title))
-            original_name_treated = show.title
-
-        for i, element in enumerate(matched_list):
-            mal_list_seasoned.append(
-                (element[0], i + 1, original_name_treated))
+    # Later seasons have longer names, e.g. "original_name 2/Final/Second Stage/!!"
+    # Every show is listed once per TV show whose name contains its name,
+    # numbered as seasons 1..n with its own name as the original name
+    matches = count_containing(tv_titles, tv_titles)
+    for (show, title), matched in zip(tv_shows, matches):
+        for season in range(1, matched + 1):
+            mal_list_seasoned.append((show, season, title))
     logger.info('[MAL] Matching seasons inside MAL list finished')
     return mal_list_seasoned
 
 
-def update_mal_list_with_seasons(mal_list_seasoned, plex_shows):
+def update_mal_list_with_seasons(context, mal_list_seasoned, plex_shows):
     """
     update_mal_list_with_seasons: complete list with all seasons for watched shows and later compare by season.
     these are seasons defined by MAL. 1 season MIGHT mean a continuous run of many AniDB/TVDB seasons, per MAL standards.
@@ -173,54 +578,89 @@ def update_mal_list_with_seasons(mal_list_seasoned, plex_shows):
     logger.info('[MAL] Retrieving updated list for season matching...')
     mal_list_seasoned_updated = [
         (x[0], x[1], x[2], 'on_mal_list') for x in mal_list_seasoned]
-    for show, (episodes, season) in plex_shows.items():
-        matches_in_mal_list_seasoned = [x for x in mal_list_seasoned
-                                        if x[2].lower() == show.title.lower()
-                                        and x[1] == season]
-        if bool(matches_in_mal_list_seasoned) or season == 1:
-            continue
-        mal_shows = spice.search(show.title, spice.get_medium('anime'), mal_credentials)
-        matched_list = []
-        for mal_show in mal_shows:
-            try:
-                if mal_show.anime_type == 'TV':
-                    match = (
-                        mal_show,
-                        mal_show.dates[1] if mal_show.dates[1] != '0000-00-00' else '9999-99-99')
-                    matched_list.append(match)
-            except BaseException:
-                logger.error(
-                    'Error during season date lookup for show: {}'.format(mal_show))
-        matched_list.sort(key=lambda x: x[1])
+    seasons_in_mal_list_seasoned = set(
+        (normalize_title(x[2]), x[1]) for x in mal_list_seasoned)
+    pending = [
+        show for show, (episodes, season) in plex_shows.items()
+        if season > 1 and (normalize_title(show.title), season) not in seasons_in_mal_list_seasoned
+        and find_anime_by_guid(context, show, season) is None]
+    # Searches of different shows are sent at the same time
+    for seasons in process_shows(
+            context, lambda show: search_mal_seasons(context, show), pending, 'mal'):
+        mal_list_seasoned_updated += seasons
+    logger.info('[MAL] Retrieving updated list for season matching finished')
+    return mal_list_seasoned_updated
+
+
+def lookup_anime(context, mal_id):
+    # Anime by MAL id from the local anime database, from MAL when not imported
+    return context.anime_db.get(mal_id) or context.mal_cache.search_id(mal_id)
+
+
+def find_anime_by_guid(context, show, season):
+    """
+    find_anime_by_guid: MAL entry of a season of a show matched by the HAMA agent, through the AniDB id
+    or the AniDB id mapped to the TVDB season in the anime database. None when there is no single
+    mapped entry, e.g. for other agents or TVDB seasons split over several AniDB entries.
+    """
+    # Read from the listing, plexapi reloads the show for missing attributes
+    guid = parse_guid(show.__dict__.get('guid'))
+    if guid is None:
+        return None
+    source, source_id = guid
+    if source == 'anidb':
+        return context.anime_db.find_by_source('anidb', source_id) if season == 1 else None
+    entries = context.anime_db.find_by_tvdb(source_id, season)
+    return entries[0] if len(entries) == 1 else None
+
+
+def search_anime(context, title):
+    return context.anime_db.search(title) or context.mal_cache.search(title)
 
-        try:
-            original_name = [
-                x[0].title for x in matched_list if x[1] != '9999-99-99']
 
-            # can't do miracles if it's all empty
-            original_name_treated = original_name[0] if original_name else matched_list[0][0].title
+def search_mal_seasons(context, show):
+    # Search MAL for all TV seasons of a show, ordered by air date
+    mal_shows = search_anime(context, show.title)
+    matched_list = []
+    for mal_show in mal_shows:
+        try:
+            if mal_show.anime_type == 'TV':
+                match = (
+                    mal_show,
+                    mal_show.dates[1] if mal_show.dates[1] != '0000-00-00' else '9999-99-99')
+                matched_list.append(match)
         except BaseException:
             logger.error(
-                'Error during original name treatment for show: {}'.format(
-                    show.title))
-            original_name_treated = show.title
+                'Error during season date lookup for show: {}'.format(mal_show))
+    matched_list.sort(key=lambda x: x[1])
 
-        for i, element in enumerate(matched_list):
-            mal_list_seasoned_updated.append(
-                (element[0], i + 1, original_name_treated, 'not_on_mal_list'))
-    logger.info('[MAL] Retrieving updated list for season matching finished')
-    return mal_list_seasoned_updated
+    try:
+        original_name = [
+            x[0].title for x in matched_list if x[1] != '9999-99-99']
+
+        # can't do miracles if it's all empty
+        original_name_treated = original_name[0] if original_name else matched_list[0][0].title
+    except BaseException:
+        logger.error(
+            'Error during original name treatment for show: {}'.format(
+                show.title))
+        original_name_treated = show.title
+
+    return [(element[0], i + 1, original_name_treated, 'not_on_mal_list')
+            for i, element in enumerate(matched_list)]
 
 
 # update an existing match
 def update_mal_entry(
+        context,
         list_item,
         plex_title,
         plex_watched_episode_count,
         force_update):
+    import spice_api as spice
     mal_watched_episode_count = int(list_item.episodes)
     mal_show_id = int(list_item.id)
-    print(mal_watched_episode_count, mal_show_id)
+    logger.debug('{} {}'.format(mal_watched_episode_count, mal_show_id))
     if mal_show_id > 0:
         if mal_watched_episode_count < plex_watched_episode_count or force_update:
             anime_new = spice.get_blank(spice.get_medium('anime'))
@@ -229,8 +669,7 @@ def update_mal_entry(
 
             # If full watched set status to completed, needs additional lookup as total episodes
             # are not exposed in list (mal or spice limitation)
-            lookup_show = spice.search_id(
-                mal_show_id, spice.get_medium('anime'), mal_credentials)
+            lookup_show = lookup_anime(context, mal_show_id)
             if lookup_show:
                 if lookup_show.episodes:
                     mal_total_episodes = int(lookup_show.episodes)
@@ -247,201 +686,630 @@ def update_mal_entry(
                     mal_watched_episode_count,
                     plex_watched_episode_count,
                     new_status))
-            spice.update(
-                anime_new,
-                mal_show_id,
-                spice.get_medium('anime'),
-                mal_credentials)
+            context.mal_writes.update(
+                anime_new, mal_show_id, plex_title,
+                'later season watched on Plex' if force_update else 'watch count on Plex is higher')
         else:
             logger.warning(
                 '[PLEX -> MAL] Watch count for {} on Plex was equal or higher on MAL so skipping update' .format(plex_title))
+            journal_match(context, list_item)
         pass
 
 
-def add_mal_entry(list_item, on_mal_list):
+def journal_match(context, list_item):
+    # A show matched to an entry on the MAL list that needs no update counts
+    # as sent to it, the next sync skips the show while the entry is unchanged
+    import spice_api as spice
+    journal = context.mal_writes.journal
+    if journal is not None:
+        journal.set_match(int(list_item.id), int(list_item.episodes), spice.get_status(list_item.status))
+
+
+def add_mal_entry(context, list_item, on_mal_list):
+    import spice_api as spice
     if on_mal_list == 'not_on_mal_list':
         logger.warning('[PLEX -> MAL] No MAL entry found for matching season of {}, adding to MAL with status Watching ]'
                        .format(list_item.title))
 
         anime_new = spice.get_blank(spice.get_medium('anime'))
         anime_new.episodes = 0
-        spice.add(anime_new,
-                  int(list_item.id),
-                  spice.get_medium('anime'),
-                  mal_credentials)
+        context.mal_writes.add(
+            anime_new, int(list_item.id), list_item.title, 'season not on MAL list')
 
 
-def send_watched_to_mal(plex_watched_shows, mal_list, mal_list_seasoned):
-    for show, value in plex_watched_shows.items():
-        plex_title = show.title
-        plex_watched_episode_count, plex_watched_episode_season = value
-        show_in_mal_list = False
-        force_update = False
-        #logger.debug('%s => watch count = %s' % (plex_title, watched_episode_count))
+def send_watched_to_mal(context, plex_watched_shows, mal_index, plan_file=None, journal=None):
+    """
+    send_watched_to_mal: match every show to MAL and send the list updates, or save them as a plan.
+    with a journal, shows matched by an earlier sync that stopped halfway are skipped and their
+    list updates that were not sent are sent, the journal is compacted once all updates were sent.
+    """
+    shows = list(plex_watched_shows.items())
+    if journal is not None:
+        shows = [(show, watched) for show, watched in shows
+                 if journal.get_show(str(show.ratingKey)) != watched]
+        writes = journal.pending_writes(set(str(show.ratingKey) for show, watched in shows))
+        resumed = len(plex_watched_shows) - len(shows)
+        if resumed or writes:
+            logger.info('[MAL] Resuming sync, {} shows were already matched and {} list updates not sent'
+                        .format(resumed, len(writes)))
+            context.mal_writes.load_writes(writes, journal=False)
+        context.mal_writes.journal = journal
 
-        if plex_watched_episode_count <= 0:
-            continue
+    def send(item):
+        show, watched = item
+        if journal is None:
+            return send_show_to_mal(context, show, watched, mal_index)
+        journal.begin_show(str(show.ratingKey))
+        send_show_to_mal(context, show, watched, mal_index)
+        journal.end_show(show.title, watched)
 
-        # All shows with season > 1 were previously searched and are part of
-        # the mal_list_seasoned object
-        if plex_watched_episode_season > 1:
-            force_update = True
-            for anime, season, original_name, on_mal_list in mal_list_seasoned:
-                if original_name.lower() == plex_title.lower():
-                    try:
-                        correct_item = [value[0] for index, value in enumerate(mal_list_seasoned)
-                                        if value[1] == plex_watched_episode_season and value[2] == original_name][0]
-                    except BaseException:
-                        # Search failed to properly match seasons, e.g. Card Captor Sakura Clear Card is s4 on TVDB and s2 here
-                        # assume most recent available season
-                        # TODO: search by ID of the correct season
-                        if force_update:
-                            correct_item = spice.search_id(
-                                int(mal_list_seasoned[-1][0].id), spice.get_medium('anime'), mal_credentials)
-                            on_mal_list = 'not_on_mal_list'
-                        else:
-                            break
-                    # Trying to add before doens't really break anything and
-                    # works for new series, since mal_list_seasoned includes
-                    # things you haven't watched yet
-                    add_mal_entry(correct_item, on_mal_list)
-                    update_mal_entry(
-                        correct_item,
-                        plex_title,
-                        plex_watched_episode_count,
-                        force_update)
-                    break
-            continue
+    try:
+        process_shows(context, send, shows, 'mal')
+        if plan_file:
+            context.mal_writes.write_plan(plan_file, mal_index)
+        else:
+            context.mal_writes.flush()
+            if journal is not None:
+                journal.compact()
+    finally:
+        context.mal_writes.journal = None
+
+
+def skip_pushed_shows(journal, plex_watched_shows, mal_list):
+    # Shows sent before are only synced again once their watch state on
+    # Plex or the MAL entries they were sent to changed
+    import spice_api as spice
+    mal_entries = {int(x.id): (int(x.episodes), spice.get_status(x.status)) for x in mal_list or list()}
+    changed = {show: watched for show, watched in plex_watched_shows.items()
+               if not journal.is_pushed(str(show.ratingKey), watched, mal_entries)}
+    logger.info('[PLEX -> MAL] {} shows are unchanged since they were sent to MAL, {} shows to sync'
+                .format(len(plex_watched_shows) - len(changed), len(changed)))
+    return changed
+
+
+def send_show_to_mal(context, show, value, mal_index):
+    import spice_api as spice
+    plex_title = show.title
+    plex_watched_episode_count, plex_watched_episode_season = value
+    show_in_mal_list = False
+    force_update = False
+    #logger.debug('%s => watch count = %s' % (plex_title, watched_episode_count))
+
+    if plex_watched_episode_count <= 0:
+        return
+
+    # Shows matched by the HAMA agent are sent by id, without comparing titles
+    anime = find_anime_by_guid(context, show, plex_watched_episode_season)
+    if anime is not None:
+        list_item = mal_index.find_by_id(anime.id)
+        if list_item is not None:
+            update_mal_entry(
+                context,
+                list_item,
+                plex_title,
+                plex_watched_episode_count,
+                force_update)
+        else:
+            mal_total_episodes = int(anime.episodes)
+            new_status = 'completed' if mal_total_episodes and \
+                plex_watched_episode_count >= mal_total_episodes else 'watching'
+            logger.warning('[PLEX -> MAL] {} matched {} by Plex GUID, adding to MAL with watch count {} and status {}'
+                           .format(plex_title, anime.title, plex_watched_episode_count, new_status))
+            anime_new = spice.get_blank(spice.get_medium('anime'))
+            anime_new.episodes = plex_watched_episode_count
+            anime_new.status = spice.get_status(new_status)
+            context.mal_writes.add(
+                anime_new, anime.id, plex_title, 'matched by Plex GUID')
+        return
+
+    # All shows with season > 1 were previously searched and are part of
+    # the mal_list_seasoned object
+    if plex_watched_episode_season > 1:
+        force_update = True
+        original = mal_index.find_original(plex_title)
+        if original:
+            anime, season, original_name = original[:3]
+            correct_item = mal_index.find_season(
+                original_name, plex_watched_episode_season)
+            if correct_item is None:
+                # Search failed to properly match seasons, e.g. Card Captor Sakura Clear Card is s4 on TVDB and s2 here
+                # assume most recent available season
+                # TODO: search by ID of the correct season
+                correct_item = lookup_anime(
+                    context, int(mal_index.mal_list_seasoned[-1][0].id))
+            # Added when the season itself is not on the list, the flag of
+            # the original name does not tell
+            on_mal_list = 'not_on_mal_list' if mal_index.find_by_id(correct_item.id) is None \
+                else 'on_mal_list'
+            add_mal_entry(context, correct_item, on_mal_list)
+            update_mal_entry(
+                context,
+                correct_item,
+                plex_title,
+                plex_watched_episode_count,
+                force_update)
+        return
+
+    # check if show is already on MAL list, by title or english title
+    for list_item in mal_index.find_by_title(plex_title):
+        show_status = spice.get_status(list_item.status)
+        logger.debug(
+            '{} [{}] was already in list => status = {} | watch count = {}' .format(
+                plex_title, list_item.id, show_status, list_item.episodes))
+        show_in_mal_list = True
+        update_mal_entry(
+            context,
+            list_item,
+            plex_title,
+            plex_watched_episode_count,
+            force_update)
 
-        # check if show is already on MAL list
-        for list_item in mal_list:
-            #logger.debug('Comparing %s with %s' % (list_item.title, plex_title))
-            mal_title = list_item.title
-            mal_title_english = ""
-            if list_item.english is not None:
-                mal_title_english = list_item.english
-                #logger.debug('Comparing original: %s | english: %s with %s' % (mal_title, mal_title_english, plex_title))
+    # Titles differing slightly from the MAL list, e.g. in romanization
+    if not show_in_mal_list:
+        list_item = mal_index.find_similar(plex_title, context.fuzzy_threshold)
+        if list_item is not None:
+            logger.info('[PLEX -> MAL] {} matched {} in MAL list by similar title'
+                        .format(plex_title, list_item.title))
+            show_in_mal_list = True
+            update_mal_entry(
+                context,
+                list_item,
+                plex_title,
+                plex_watched_episode_count,
+                force_update)
+
+    # If not listed in list lookup on MAL
+    if not show_in_mal_list:
+        found_result = False
+        update_list = True
+        on_mal_list = False
+        potential_titles = [
+            plex_title.lower(),
+            context.parsed_titles.parse(plex_title).lower()]
+        # Compared without punctuation, case and season suffix spelling
+        potential_keys = set(title_key(title) for title in potential_titles)
+
+        # The local anime database and entries found by earlier searches are
+        # tried before searching MAL
+        mal_shows = list()
+        for title in potential_titles:
+            mal_shows = context.anime_db.find_by_title(title)
+            if len(mal_shows) >= 1:
+                break
+
+        if mal_shows:
+            logger.info('[PLEX -> MAL] {} not in MAL list, found in the anime database'
+                        .format(plex_title))
+            # Matched by synonym
+            potential_keys.update(title_key(x.title) for x in mal_shows)
+        else:
+            mal_show = context.mal_cache.find_similar(plex_title, context.fuzzy_threshold)
+            if mal_show is not None:
+                logger.info('[PLEX -> MAL] {} not in MAL list, matched {} by similar title'
+                            .format(plex_title, mal_show.title))
+                mal_shows = [mal_show]
+                potential_keys.add(title_key(mal_show.title))
             else:
-                #logger.debug('Comparing original: %s with %s' % (mal_title, plex_title))
+                logger.info('[PLEX -> MAL] {} not in MAL list, searching for show on MAL'
+                            .format(plex_title))
+                for title in potential_titles:
+                    mal_shows = context.mal_cache.search(title)
+                    if len(mal_shows) >= 1:
+                        break
+
+        for mal_show in mal_shows:
+            mal_title = title_key(mal_show.title)
+            mal_title_english = None
+            mal_show_id = int(mal_show.id)
+            mal_total_episodes = int(mal_show.episodes)
+
+            if mal_show.english:
+                mal_title_english = title_key(mal_show.english)
+                #logger.debug('Comparing original: %s | english: %s with %s' % (mal_title, mal_title_english, plex_title.lower()))
+            else:
+                #logger.debug('Comparing original: %s with %s' % (mal_title, plex_title.lower()))
                 pass
 
-            if mal_title.lower() == plex_title.lower(
-            ) or mal_title_english.lower() == plex_title.lower():
-                show_status = spice.get_status(list_item.status)
-                logger.debug(
-                    '{} [{}] was already in list => status = {} | watch count = {}' .format(
-                        plex_title, list_item.id, show_status, list_item.episodes))
-                show_in_mal_list = True
-                update_mal_entry(
-                    list_item,
-                    plex_title,
-                    plex_watched_episode_count,
-                    force_update)
-
-        # If not listed in list lookup on MAL
-        if not show_in_mal_list:
-            found_result = False
-            update_list = True
-            on_mal_list = False
-            logger.info('[PLEX -> MAL] {} not in MAL list, searching for show on MAL'
-                        .format(plex_title))
+            if mal_title in potential_keys or mal_title_english in potential_keys:
+                found_result = True
 
-            potential_titles = [
-                plex_title.lower(),
-                guessit(plex_title)['title'].lower()]
-            for title in potential_titles:
-                mal_shows = spice.search(
-                    title, spice.get_medium('anime'), mal_credentials)
-                if len(mal_shows) >= 1:
-                    break
-
-            for mal_show in mal_shows:
-                mal_title = mal_show.title.lower()
-                mal_title_english = ''
-                mal_show_id = int(mal_show.id)
-                mal_total_episodes = int(mal_show.episodes)
-
-                if mal_show.english:
-                    mal_title_english = mal_show.english.lower()
-                    #logger.debug('Comparing original: %s | english: %s with %s' % (mal_title, mal_title_english, plex_title.lower()))
-                else:
-                    #logger.debug('Comparing original: %s with %s' % (mal_title, plex_title.lower()))
-                    pass
-
-                if mal_title in potential_titles or mal_title_english in potential_titles:
-                    found_result = True
-
-                    # double check against MAL list using id to see if matches
-                    # and update is required
-                    for list_item in mal_list:
-                        mal_list_id = int(list_item.id)
-                        mal_list_watched_episode_count = int(
-                            list_item.episodes)
-
-                        if mal_list_id == mal_show_id:
-                            on_mal_list = True
-                            if plex_watched_episode_count == mal_list_watched_episode_count:
-                                logger.warning(
-                                    '[PLEX -> MAL] show was found in current MAL list using id lookup however watch count was identical so skipping update')
-                                update_list = False
-                            break
-
-                    if update_list:
-                        logger.warning('[PLEX -> MAL] Found match on MAL and setting state to watching with watch count: {}'
-                                       .format(plex_watched_episode_count))
-                        anime_new = spice.get_blank(spice.get_medium('anime'))
-                        anime_new.episodes = plex_watched_episode_count
-
-                        if plex_watched_episode_count >= mal_total_episodes:
-                            anime_new.status = spice.get_status('completed')
-                            if on_mal_list:
-                                spice.update(
-                                    anime_new,
-                                    mal_show.id,
-                                    spice.get_medium('anime'),
-                                    mal_credentials)
-                            else:
-                                spice.add(
-                                    anime_new,
-                                    mal_show.id,
-                                    spice.get_medium('anime'),
-                                    mal_credentials)
+                # double check against MAL list using id to see if matches
+                # and update is required
+                list_item = mal_index.find_by_id(mal_show_id)
+                if list_item is not None:
+                    on_mal_list = True
+                    if plex_watched_episode_count == int(list_item.episodes):
+                        logger.warning(
+                            '[PLEX -> MAL] show was found in current MAL list using id lookup however watch count was identical so skipping update')
+                        journal_match(context, list_item)
+                        update_list = False
+
+                if update_list:
+                    logger.warning('[PLEX -> MAL] Found match on MAL and setting state to watching with watch count: {}'
+                                   .format(plex_watched_episode_count))
+                    anime_new = spice.get_blank(spice.get_medium('anime'))
+                    anime_new.episodes = plex_watched_episode_count
+
+                    if plex_watched_episode_count >= mal_total_episodes:
+                        anime_new.status = spice.get_status('completed')
+                        if on_mal_list:
+                            context.mal_writes.update(
+                                anime_new, mal_show.id, plex_title, 'found on MAL by search')
                         else:
-                            anime_new.status = spice.get_status('watching')
-                            if on_mal_list:
-                                spice.update(
-                                    anime_new,
-                                    mal_show.id,
-                                    spice.get_medium('anime'),
-                                    mal_credentials)
-                            else:
-                                spice.add(
-                                    anime_new,
-                                    mal_show.id,
-                                    spice.get_medium('anime'),
-                                    mal_credentials)
-                    break
-
-            if not found_result:
-                logger.error(
-                    '[PLEX -> MAL] Failed to find {} on MAL'.format(plex_title))
-
-
-def start():
+                            context.mal_writes.add(
+                                anime_new, mal_show.id, plex_title, 'found on MAL by search')
+                    else:
+                        anime_new.status = spice.get_status('watching')
+                        if on_mal_list:
+                            context.mal_writes.update(
+                                anime_new, mal_show.id, plex_title, 'found on MAL by search')
+                        else:
+                            context.mal_writes.add(
+                                anime_new, mal_show.id, plex_title, 'found on MAL by search')
+                break
+
+        if not found_result:
+            logger.error(
+                '[PLEX -> MAL] Failed to find {} on MAL'.format(plex_title))
+
+
+def sync_watched_shows(context, plex_watched_shows, mal_index):
+    # Add MAL seasons of later seasons missing in the index and send
+    pending = [
+        show for show, (episodes, season) in plex_watched_shows.items()
+        if season > 1 and not mal_index.has_season(show.title, season)
+        and find_anime_by_guid(context, show, season) is None]
+    for seasons in process_shows(
+            context, lambda show: search_mal_seasons(context, show), pending, 'mal'):
+        mal_index.extend(seasons)
+    send_watched_to_mal(context, plex_watched_shows, mal_index)
+
+
+def reconcile(context, state):
+    """
+    reconcile: refresh the MAL list and sync shows changed since the last sync using an incremental scan.
+    returns the MAL list index used to sync shows reported by Plex until the next refresh.
+    """
+    synced = dict(state.shows)
+    shows = get_anime_shows(context)
+    watched_shows = get_plex_watched_shows(context, shows, state, full=False)
+
+    mal_list = get_mal_list(context)
+    mal_index = MalListIndex(
+        mal_list,
+        [(x[0], x[1], x[2], 'on_mal_list') for x in match_seasons_on_mal_list(mal_list)])
+
+    changed = {show: watched for show, watched in watched_shows.items()
+               if synced.get(str(show.ratingKey), (None, None))[1] != watched}
+    sync_watched_shows(context, changed, mal_index)
+    state.save(set(str(show.ratingKey) for show in shows))
+    return mal_index
+
+
+def get_alert_rating_keys(data):
+    # Episodes that stopped playing or that were updated (e.g. marked as
+    # watched)
+    rating_keys = list()
+    if data.get('type') == 'playing':
+        for notification in data.get('PlaySessionStateNotification', []):
+            if notification.get('state') == 'stopped':
+                rating_keys.append(notification.get('ratingKey'))
+    elif data.get('type') == 'timeline':
+        for entry in data.get('TimelineEntry', []):
+            # Type 4 is episode, state 5 is done processing
+            if entry.get('type') == 4 and entry.get('state') == 5:
+                rating_keys.append(entry.get('itemID'))
+    return [rating_key for rating_key in rating_keys if rating_key]
+
+
+def sync_rating_keys(context, rating_keys, section_key, state, mal_index):
+    shows = dict()
+    for rating_key in rating_keys:
+        try:
+            episode = context.plex.fetchItem(int(rating_key))
+            if episode.type != 'episode' or str(episode.librarySectionID) != str(section_key):
+                continue
+            show_key = str(episode.grandparentRatingKey)
+            if show_key not in shows:
+                shows[show_key] = context.plex.fetchItem(int(show_key))
+        except BaseException:
+            logger.error(
+                '[PLEX] Failed to retrieve played item {}'.format(rating_key))
+
+    watched_shows = dict()
+    changed = dict()
+    for show_key, show in shows.items():
+        episodes_watched, season_watched = calculate_watched(get_show_episodes(show))
+        if state.get_show(show_key) == (episodes_watched, season_watched):
+            continue
+        changed[show_key] = (show.title, (episodes_watched, season_watched))
+        if episodes_watched > 0:
+            watched_shows[show] = (episodes_watched, season_watched)
+            logger.info(
+                'Watched {} episodes of show: {}'.format(
+                    episodes_watched, show.title))
+    if watched_shows:
+        sync_watched_shows(context, watched_shows, mal_index)
+    # Only stored once sent, a failed sync is tried again by the next event
+    # or refresh
+    for show_key, (title, watched) in changed.items():
+        state.set_show(show_key, title, watched)
+    state.save()
+
+
+def daemon(context=None):
+    """
+    daemon: keep running and sync shows within seconds of Plex reporting played episodes.
+    every refresh_interval minutes the MAL list is refreshed and the library scanned incrementally
+    to pick up anything the listener missed.
+    """
+    context = context or SyncContext.from_file()
+    state = SyncState(context.state_file)
+    refresh_interval = context.sync_settings.getfloat('refresh_interval', fallback=60) * 60
+    event_delay = context.sync_settings.getfloat('event_delay', fallback=10)
+    section_key = context.plex.library.section(context.plex_settings['anime_section']).key
+    events = queue.Queue()
+
+    def on_alert(data):
+        for rating_key in get_alert_rating_keys(data):
+            events.put(rating_key)
+
+    listener = context.plex.startAlertListener(on_alert)
+    logger.info('[PLEX] Listening for played episodes...')
+    mal_index = None
+    try:
+        while True:
+            # Plex or MAL being unreachable should not stop the daemon, a
+            # failed refresh is retried within a minute
+            try:
+                mal_index = reconcile(context, state)
+                next_refresh = time.time() + refresh_interval
+            except Exception:
+                # Shows and watermark of the failed refresh are scanned again
+                state.rollback()
+                retry_interval = min(refresh_interval, 60)
+                logger.exception('[PLEX -> MAL] Sync failed, retrying in {:.0f} seconds'.format(retry_interval))
+                next_refresh = time.time() + retry_interval
+            while time.time() < next_refresh:
+                # The listener stops when the connection to Plex drops, the
+                # refresh picks up what was played in the meantime
+                if not listener.is_alive():
+                    try:
+                        listener = context.plex.startAlertListener(on_alert)
+                        logger.warning('[PLEX] Alert listener stopped, listening again')
+                    except Exception:
+                        logger.exception('[PLEX] Failed to listen for played episodes')
+                try:
+                    rating_keys = {events.get(
+                        timeout=min(max(0, next_refresh - time.time()), 60))}
+                except queue.Empty:
+                    continue
+                # Give Plex time to update the watched state and collect the
+                # other events of the same moment
+                time.sleep(event_delay)
+                while not events.empty():
+                    rating_keys.add(events.get())
+                # Without a MAL list the next refresh scans these episodes
+                if mal_index is None:
+                    continue
+                try:
+                    sync_rating_keys(context, rating_keys, section_key, state, mal_index)
+                except Exception:
+                    state.rollback()
+                    logger.exception('[PLEX -> MAL] Failed to sync {} played episodes'.format(len(rating_keys)))
+    except KeyboardInterrupt:
+        logger.info('Stopping Plex to MAL sync')
+    finally:
+        listener.stop()
+        state.close()
+        context.close()
+
+
+def apply_plan(plan_file, context=None):
+    context = context or SyncContext.from_file()
+    context.mal_writes.load_plan(plan_file)
+    context.mal_writes.flush()
+    context.close()
+    logger.info('Plex to MAL sync plan applied')
+
+
+def import_anime_db(files, context=None):
+    context = context or SyncContext.from_file()
+    for file in files:
+        logger.info('Importing {} into the anime database...'.format(file))
+        count = context.anime_db.import_file(file)
+        logger.info('Imported {} entries from {}'.format(count, file))
+    context.close()
+
+
+def report_metrics(context):
+    for line in context.metrics.summary():
+        logger.info('[METRICS] {}'.format(line))
+    metrics_file = context.sync_settings.get('metrics_file', fallback='')
+    if metrics_file:
+        try:
+            context.metrics.export(metrics_file)
+        except OSError as e:
+            logger.error('[METRICS] Failed to write {}: {}'.format(metrics_file, e))
+
+
+def scan_plex(context, state, full=False):
     # Watched shows
-    shows = get_anime_shows()
-    watched_shows = get_plex_watched_shows(shows)
+    metrics = context.metrics
+    with metrics.stage('get_anime_shows'):
+        shows = get_anime_shows(context)
+    with metrics.stage('get_plex_watched_shows'):
+        watched_shows = get_plex_watched_shows(context, shows, state, full)
+    return shows, watched_shows
+
 
-    mal_list = get_mal_list()
+def sync_to_mal(context, watched_shows, plan_file=None, full=False):
+    metrics = context.metrics
+    # Progress is journaled to resume a sync that stopped halfway, a plan
+    # only reads which shows were sent before
+    journal = SyncJournal(context.state_file)
+    try:
+        with metrics.stage('get_mal_list'):
+            mal_list = get_mal_list(context)
+        if not full:
+            with metrics.stage('skip_pushed_shows'):
+                watched_shows = skip_pushed_shows(journal, watched_shows, mal_list)
 
-    # Add seasons to list
-    mal_list_seasoned = match_seasons_on_mal_list(mal_list)
-    updated_mal_list = update_mal_list_with_seasons(
-        mal_list_seasoned, watched_shows)
+        # Add seasons to list
+        with metrics.stage('match_seasons_on_mal_list'):
+            mal_list_seasoned = match_seasons_on_mal_list(mal_list)
+        with metrics.stage('update_mal_list_with_seasons'):
+            updated_mal_list = update_mal_list_with_seasons(
+                context, mal_list_seasoned, watched_shows)
 
-    send_watched_to_mal(watched_shows, mal_list, updated_mal_list)
+        with metrics.stage('send_watched_to_mal'):
+            mal_index = MalListIndex(mal_list, updated_mal_list)
+            send_watched_to_mal(
+                context, watched_shows, mal_index, plan_file, None if plan_file else journal)
+    finally:
+        journal.close()
+
+
+def start(full=False, plan_file=None, context=None):
+    # Settings are read and Plex and MAL authenticated once needed
+    context = context or SyncContext.from_file()
+    state = SyncState(context.state_file)
+    shows, watched_shows = scan_plex(context, state, full)
+    sync_to_mal(context, watched_shows, plan_file, full)
+    if plan_file:
+        # Nothing was sent, keep the state of the last sync
+        state.close()
+        context.close()
+        report_metrics(context)
+        logger.info('Plex to MAL sync plan finished')
+        return
+
+    # Only remember progress once it has been sent to MAL
+    state.save(set(str(show.ratingKey) for show in shows))
+    state.close()
+    context.close()
+    report_metrics(context)
     logger.info('Plex to MAL sync finished')
 
 
+def profile_start(stats_file, full=False, plan_file=None, context=None):
+    """
+    profile_start: run start() with every stage profiled, log the hot functions of every stage and save
+    the stats to stats_file (pstats) and the sampled stacks next to it (collapsed stacks for flame graphs).
+    """
+    from profiling import StageProfiler
+    context = context or SyncContext.from_file()
+    profiler = StageProfiler()
+    context.metrics.profiler = profiler
+    try:
+        start(full, plan_file, context)
+    finally:
+        for line in profiler.summary():
+            logger.info('[PROFILE] {}'.format(line))
+        collapsed = profiler.save(stats_file)
+        logger.info('[PROFILE] Saved the stats to {} and the stacks to {}'.format(stats_file, collapsed))
+
+
+def sync_profiles(full=False, plan_file=None, settings=None):
+    """
+    sync_profiles: sync every profile of the settings in one run.
+    profiles with the same Plex settings share one library scan, the MAL stages of all profiles run at
+    the same time with the write queue, rate limits and connections of their own MAL account and one
+    search cache, title cache and anime database.
+    """
+    settings = settings or read_settings(settings_file)
+    names = get_profiles(settings)
+    # Searches are sent with the credentials of the first profile
+    shared = SyncContext(profile_settings(settings, names[0]))
+    contexts = [SyncContext(profile_settings(settings, name), name, shared) for name in names]
+    groups = OrderedDict()
+    for context in contexts:
+        plex_settings = tuple(sorted(context.settings.items('PLEX', raw=True)))
+        groups.setdefault(plex_settings, list()).append(context)
+
+    def sync_profile(context, watched_shows):
+        logger.info('[{}] Syncing to MAL account {}...'.format(
+            context.name, context.mal_settings['username']))
+        try:
+            sync_to_mal(context, watched_shows, plan_file and profile_file(plan_file, context.name), full)
+        except Exception:
+            logger.exception('[{}] Sync failed'.format(context.name))
+            return False
+        finally:
+            context.close()
+            report_metrics(context)
+        return True
+
+    def sync_group(group):
+        # The sync state of a library is kept in the state file of its
+        # first profile
+        state = SyncState(group[0].state_file)
+        try:
+            shows, watched_shows = scan_plex(group[0], state, full)
+            with ThreadPoolExecutor(max_workers=len(group)) as executor:
+                synced = list(executor.map(lambda context: sync_profile(context, watched_shows), group))
+            # Progress of a profile that failed is sent again next time
+            if all(synced) and not plan_file:
+                state.save(set(str(show.ratingKey) for show in shows))
+        finally:
+            state.close()
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+            list(executor.map(sync_group, groups.values()))
+    finally:
+        shared.close()
+    logger.info('Plex to MAL sync of {} profiles finished'.format(len(contexts)))
+
+
 if __name__ == '__main__':
-    start()
+    parser = argparse.ArgumentParser(
+        description='Sync watched anime from Plex to MyAnimeList')
+    parser.add_argument(
+        '--full', action='store_true',
+        help='ignore the stored sync state, rescan the whole library and sync shows already sent to MAL')
+    parser.add_argument(
+        '--plan', metavar='FILE',
+        help='save the MAL updates a sync would make to FILE (JSON lines) without sending them')
+    parser.add_argument(
+        '--apply', metavar='FILE',
+        help='send the MAL updates of a plan saved with --plan')
+    parser.add_argument(
+        '--daemon', action='store_true',
+        help='keep running and sync shows as soon as episodes are played on Plex')
+    parser.add_argument(
+        '--import-anime-db', metavar='FILE', action='append',
+        help='import an anime-offline-database JSON or HAMA anime-list XML file used instead of MAL searches')
+    parser.add_argument(
+        '--profile', metavar='FILE',
+        help='profile the sync, save the stats to FILE (pstats) and the stacks to FILE with the extension '
+             '.collapsed for flame graphs')
+    parser.add_argument(
+        '--sync-profile', metavar='NAME',
+        help='only sync the profile of the [MAL NAME] section, required by --apply, --daemon and --profile with profiles')
+    args = parser.parse_args()
+    if args.import_anime_db:
+        import_anime_db(args.import_anime_db)
+    elif args.sync_profile:
+        context = SyncContext.from_file(settings_file, args.sync_profile)
+        if args.apply:
+            apply_plan(args.apply, context)
+        elif args.daemon:
+            daemon(context)
+        elif args.profile:
+            profile_start(args.profile, args.full, args.plan, context)
+        else:
+            start(args.full, args.plan, context)
+    elif get_profiles(read_settings(settings_file)):
+        if args.apply or args.daemon or args.profile:
+            logger.critical('[CONFIG] Choose the profile to use with --sync-profile')
+            sys.exit()
+        sync_profiles(args.full, args.plan)
+    elif args.apply:
+        apply_plan(args.apply)
+    elif args.daemon:
+        daemon()
+    elif args.profile:
+        profile_start(args.profile, args.full, args.plan)
+    else:
+        start(args.full, args.plan)
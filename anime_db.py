@@ -0,0 +1,166 @@
+import json
+import sqlite3
+import threading
+from urllib.parse import urlparse
+from xml.etree import ElementTree
+from matching import normalize_title, title_key
+
+# anime-offline-database values => values used by MAL and spice_api
+TYPES = {'MOVIE': 'Movie', 'SPECIAL': 'Special'}
+STATUSES = {'FINISHED': 'Finished Airing', 'ONGOING': 'Currently Airing', 'UPCOMING': 'Not yet aired'}
+SEASON_MONTHS = {'WINTER': '01', 'SPRING': '04', 'SUMMER': '07', 'FALL': '10'}
+
+
+class AnimeRecord:
+    """
+    AnimeRecord: anime of the local anime database with the attributes of a spice search result Anime
+    used by the sync, dates are (start, end) with the end set to the start once finished as only the
+    airing season is known.
+    """
+    __slots__ = ('id', 'title', 'english', 'episodes', 'anime_type', 'status', 'dates')
+
+    def __init__(self, id, title, anime_type, episodes, status, start_date, end_date):
+        self.id = str(id)
+        self.title = title
+        self.english = None
+        self.episodes = str(episodes or 0)
+        self.anime_type = anime_type
+        self.status = status
+        self.dates = (start_date, end_date)
+
+
+class AnimeDatabase:
+    """
+    AnimeDatabase: local copy of an anime metadata dump in the state database, so ids, titles and
+    episode counts are resolved without MAL searches.
+    imports the anime-offline-database JSON (https://github.com/manami-project/anime-offline-database),
+    keyed by MAL id with the ids of the other sites and all titles and synonyms, and the HAMA
+    anime-list-master.xml (https://github.com/Anime-Lists/anime-lists) AniDB => TVDB mapping.
+    """
+
+    def __init__(self, file):
+        # Shared by worker threads
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file, check_same_thread=False)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS anime_db (
+                mal_id INTEGER PRIMARY KEY,
+                title TEXT,
+                type TEXT,
+                episodes INTEGER,
+                status TEXT,
+                start_date TEXT,
+                end_date TEXT);
+            CREATE TABLE IF NOT EXISTS anime_db_ids (
+                source TEXT,
+                id TEXT,
+                mal_id INTEGER,
+                PRIMARY KEY (source, id));
+            CREATE TABLE IF NOT EXISTS anime_db_titles (
+                title TEXT,
+                season TEXT,
+                mal_id INTEGER,
+                PRIMARY KEY (title, season, mal_id));
+            CREATE TABLE IF NOT EXISTS anime_db_tvdb (
+                anidb_id TEXT PRIMARY KEY,
+                tvdb_id TEXT,
+                tvdb_season TEXT);
+            CREATE INDEX IF NOT EXISTS anime_db_tvdb_id ON anime_db_tvdb (tvdb_id, tvdb_season);''')
+
+    def import_file(self, file):
+        # Returns the number of imported entries
+        if file.lower().endswith('.xml'):
+            return self.import_anime_list(file)
+        return self.import_offline_database(file)
+
+    def import_offline_database(self, file):
+        with open(file, encoding='utf-8') as source:
+            data = json.load(source)['data']
+        anime = list()
+        ids = list()
+        titles = set()
+        for entry in data:
+            sources = dict()
+            for url in entry.get('sources', ()):
+                parsed = urlparse(url)
+                site = parsed.netloc.split('.')[-2] if '.' in parsed.netloc else parsed.netloc
+                sources[site] = parsed.path.rstrip('/').split('/')[-1]
+            mal_id = sources.pop('myanimelist', None)
+            if not mal_id or not mal_id.isdigit():
+                continue
+            mal_id = int(mal_id)
+            season = entry.get('animeSeason') or dict()
+            start_date = '0000-00-00'
+            if season.get('year'):
+                start_date = '{}-{}-01'.format(season['year'], SEASON_MONTHS.get(season.get('season'), '01'))
+            status = STATUSES.get(entry.get('status'), 'Unknown')
+            end_date = start_date if status == 'Finished Airing' else '0000-00-00'
+            anime.append((
+                mal_id, entry['title'], TYPES.get(entry.get('type'), entry.get('type')),
+                entry.get('episodes') or 0, status, start_date, end_date))
+            ids += [(site, site_id, mal_id) for site, site_id in sources.items()]
+            for title in [entry['title']] + entry.get('synonyms', list()):
+                titles.add(title_key(title) + (mal_id,))
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM anime_db')
+            self.connection.execute('DELETE FROM anime_db_ids')
+            self.connection.execute('DELETE FROM anime_db_titles')
+            self.connection.executemany('INSERT OR REPLACE INTO anime_db VALUES (?, ?, ?, ?, ?, ?, ?)', anime)
+            self.connection.executemany('INSERT OR REPLACE INTO anime_db_ids VALUES (?, ?, ?)', ids)
+            self.connection.executemany('INSERT OR REPLACE INTO anime_db_titles VALUES (?, ?, ?)', titles)
+        return len(anime)
+
+    def import_anime_list(self, file):
+        mappings = list()
+        for event, element in ElementTree.iterparse(file):
+            if element.tag == 'anime':
+                mappings.append((element.get('anidbid'), element.get('tvdbid'),
+                                 element.get('defaulttvdbseason')))
+                element.clear()
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM anime_db_tvdb')
+            self.connection.executemany('INSERT OR REPLACE INTO anime_db_tvdb VALUES (?, ?, ?)', mappings)
+        return len(mappings)
+
+    def get(self, mal_id):
+        return next(iter(self._records('WHERE mal_id = ?', (int(mal_id),))), None)
+
+    def find_by_title(self, title):
+        # Entries with the same title or synonym, ignoring case, punctuation
+        # and the spelling of the season suffix
+        return self._records(
+            'WHERE mal_id IN (SELECT mal_id FROM anime_db_titles WHERE title = ? AND season = ?)',
+            title_key(title))
+
+    def find_by_source(self, source, source_id):
+        # source is the site name of the id, e.g. anidb, anilist or kitsu
+        return next(iter(self._records(
+            'WHERE mal_id = (SELECT mal_id FROM anime_db_ids WHERE source = ? AND id = ?)',
+            (source, str(source_id)))), None)
+
+    def find_by_tvdb(self, tvdb_id, season):
+        # Mapped through the AniDB id of the TVDB season
+        return self._records(
+            '''WHERE mal_id IN (SELECT mal_id FROM anime_db_ids JOIN anime_db_tvdb
+               ON source = 'anidb' AND id = anidb_id WHERE tvdb_id = ? AND tvdb_season = ?)''',
+            (str(tvdb_id), str(season)))
+
+    def search(self, title):
+        # Entries with a title starting with title, like a MAL search this
+        # finds all seasons of a show
+        prefix = normalize_title(title)
+        if not prefix:
+            return list()
+        return self._records(
+            'WHERE mal_id IN (SELECT mal_id FROM anime_db_titles WHERE title >= ? AND title < ?)',
+            (prefix, prefix + '\uffff'))
+
+    def _records(self, where, parameters):
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT mal_id, title, type, episodes, status, start_date, end_date FROM anime_db '
+                '{} ORDER BY mal_id'.format(where), parameters).fetchall()
+        return [AnimeRecord(*row) for row in rows]
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,94 @@
+"""
+Compares calculating the watch progress of bulk retrieved episodes per show (episode tuples grouped
+and sorted per show, then calculate_watched() for every show) with the columns of an EpisodeTable,
+calculated at once with NumPy, on synthetic episodes including specials, rewatched and unnumbered episodes.
+Both must give the same episodes and season watched for every show.
+
+Usage: python benchmarks/episode_table.py [episodes] [shows]
+"""
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from watch_progress import EpisodeTable, calculate_watched  # noqa: E402
+
+
+def generate(episodes, shows, seed=0):
+    # (show key, Plex season, season, episode, watched) in the order of the
+    # Plex listing, which is not ordered by show
+    rng = random.Random(seed)
+    rows = list()
+    while len(rows) < episodes:
+        key = str(rng.randint(1, shows))
+        seasons = rng.randint(1, 4)
+        watched_until = (rng.randint(0, seasons), rng.randint(0, 26))
+        for plex_season in range(0 if rng.random() < 0.2 else 1, seasons + 1):
+            for index in range(1, rng.randint(2, 26)):
+                watched = (plex_season, index) <= watched_until or rng.random() < 0.05
+                rows.append((key, plex_season, plex_season or 1,
+                             None if rng.random() < 0.01 else index, watched))
+                # Episodes in several files or listed twice
+                if rng.random() < 0.02:
+                    rows.append((key, plex_season, plex_season or 1, index, rng.random() < 0.5))
+    rng.shuffle(rows)
+    return rows
+
+
+def calculate_loop(rows):
+    # Same steps as get_plex_episodes() and get_plex_watched_shows() without columns
+    episodes = defaultdict(list)
+    for key, plex_season, season, index, watched in rows:
+        episodes[key].append(((plex_season, index or 0), (season, index, watched)))
+    for key, show_episodes in episodes.items():
+        show_episodes.sort(key=lambda x: x[0])
+        episodes[key] = [x[1] for x in show_episodes]
+    progress = {key: calculate_watched(show_episodes) for key, show_episodes in episodes.items()}
+    # Shows without a watched episode are left out like by EpisodeTable
+    return {key: watched for key, watched in progress.items() if watched != (0, 1)}
+
+
+def fill_table(rows):
+    table = EpisodeTable()
+    for row in rows:
+        table.append(*row)
+    return table
+
+
+def calculate_table(table):
+    progress = table.calculate_watched()
+    return {key: watched for key, watched in progress.items() if watched != (0, 1)}
+
+
+def measure(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+
+if __name__ == '__main__':
+    episodes = int(sys.argv[1]) if len(sys.argv) > 1 else 40000
+    shows = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    if not EpisodeTable.vectorized():
+        print('NumPy is not installed, the table is calculated per show')
+    else:
+        # Imported on first use by the table, not part of the calculation
+        import numpy  # noqa: F401
+    rows = generate(episodes, shows)
+
+    loop_progress, loop_time = measure(calculate_loop, rows)
+    table, fill_time = measure(fill_table, rows)
+    table_progress, table_time = measure(calculate_table, table)
+    if loop_progress != table_progress:
+        differing = [key for key in loop_progress if loop_progress[key] != table_progress.get(key)]
+        sys.exit('Watch progress differs for {} shows, e.g. {}: {} != {}'.format(
+            len(differing), differing[0], loop_progress[differing[0]], table_progress.get(differing[0])))
+
+    print('episodes: {}, shows with watched episodes: {}'.format(len(rows), len(loop_progress)))
+    print('per show loop: {:.3f}s'.format(loop_time))
+    print('episode table: {:.3f}s filling the columns, {:.3f}s calculating'.format(fill_time, table_time))
+    print('speedup:       {:.1f}x, {:.1f}x including filling the columns'.format(
+        loop_time / table_time, loop_time / (fill_time + table_time)))
@@ -0,0 +1,102 @@
+"""
+Compares matching watched Plex shows against the MAL list by scanning the list (previous
+send_watched_to_mal behaviour) with the MalListIndex lookups, on a synthetic list.
+
+Usage: python benchmarks/mal_list_matching.py [list_size] [watched_shows]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from matching import MalListIndex  # noqa: E402
+
+
+class ListItem:
+    def __init__(self, id, title, english, episodes):
+        self.id = str(id)
+        self.title = title
+        self.english = english
+        self.episodes = str(episodes)
+
+
+def generate(list_size, watched_shows, seed=0):
+    rng = random.Random(seed)
+    mal_list = list()
+    for i in range(list_size):
+        title = 'Anime Title {}'.format(i)
+        english = 'English Title {}'.format(i) if rng.random() < 0.6 else None
+        mal_list.append(ListItem(i + 1, title, english, rng.randint(0, 24)))
+    mal_list_seasoned = list()
+    for item in mal_list:
+        for season in range(1, rng.randint(1, 3) + 1):
+            mal_list_seasoned.append((item, season, item.title, 'on_mal_list'))
+
+    plex = list()
+    for i in range(watched_shows):
+        item = rng.choice(mal_list)
+        choice = rng.random()
+        if choice < 0.4:
+            title = item.title.upper()
+        elif choice < 0.7 and item.english:
+            title = item.english
+        else:
+            title = 'Unlisted Title {}'.format(i)
+        plex.append((title, int(item.id), rng.randint(1, 3)))
+    return mal_list, mal_list_seasoned, plex
+
+
+def match_scan(mal_list, mal_list_seasoned, plex):
+    matched = 0
+    for plex_title, mal_id, season in plex:
+        for anime, _, original_name, on_mal_list in mal_list_seasoned:
+            if original_name.lower() == plex_title.lower():
+                [value[0] for value in mal_list_seasoned
+                 if value[1] == season and value[2] == original_name]
+                break
+        for list_item in mal_list:
+            english = list_item.english if list_item.english is not None else ''
+            if list_item.title.lower() == plex_title.lower() or english.lower() == plex_title.lower():
+                matched += 1
+        for list_item in mal_list:
+            if int(list_item.id) == mal_id:
+                break
+    return matched
+
+
+def match_index(mal_list, mal_list_seasoned, plex):
+    matched = 0
+    index = MalListIndex(mal_list, mal_list_seasoned)
+    for plex_title, mal_id, season in plex:
+        original = index.find_original(plex_title)
+        if original:
+            index.find_season(original[2], season)
+        matched += len(index.find_by_title(plex_title))
+        index.find_by_id(mal_id)
+    return matched
+
+
+def measure(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+
+if __name__ == '__main__':
+    list_size = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    watched_shows = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    data = generate(list_size, watched_shows)
+
+    scan_matched, scan_time = measure(match_scan, *data)
+    index_matched, index_time = measure(match_index, *data)
+    if scan_matched != index_matched:
+        sys.exit('Matching results differ: {} != {}'.format(
+            scan_matched, index_matched))
+
+    print('MAL list entries: {}, watched shows: {}, matched: {}'.format(
+        list_size, watched_shows, index_matched))
+    print('list scan:  {:.3f}s'.format(scan_time))
+    print('list index: {:.3f}s (including building the index)'.format(index_time))
+    print('speedup:    {:.0f}x'.format(scan_time / index_time))
@@ -0,0 +1,83 @@
+"""
+Profiles a full sync (PlexMALSync.start() like --profile) against the offline Plex server and MAL
+stand-ins of benchmarks/offline.py, so it runs without network. The hot functions of every stage are
+printed, the stats are saved to FILE (pstats) and the sampled stacks to FILE with the extension
+.collapsed, e.g. for flamegraph.pl: flamegraph.pl sync.collapsed > sync.svg
+
+Usage: python benchmarks/profile_sync.py [--size 1000] [--fixtures DIR] [--workers N]
+                                         [--latency SECONDS] [--anime-db] [--top N] [--output FILE]
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import warnings
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    from offline import MAL_USERNAME, SECTION_TITLE, Fixtures, OfflineMal, OfflinePlex
+    from sync_stages import SETTINGS
+
+    parser = argparse.ArgumentParser(
+        description='Profile a sync against offline Plex and MAL fixtures')
+    parser.add_argument('--size', type=int, default=1000, help='number of shows of the synthetic library')
+    parser.add_argument(
+        '--fixtures', metavar='DIR',
+        help='use the recorded responses in DIR instead of a synthetic library')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument(
+        '--latency', type=float, default=0,
+        help='seconds every Plex and MAL request takes')
+    parser.add_argument(
+        '--anime-db', action='store_true',
+        help='import the anime-offline-database and anime-list of the fixtures before the sync')
+    parser.add_argument('--top', type=int, default=10, help='number of hot functions printed per stage')
+    parser.add_argument('--output', metavar='FILE', default='sync.pstats',
+                        help='pstats file, the collapsed stacks are saved next to it')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+
+    warnings.simplefilter('ignore')
+    fixtures = Fixtures.load(args.fixtures) if args.fixtures else Fixtures.generate(args.size, args.seed)
+
+    # The state file is created in the working directory
+    os.chdir(tempfile.mkdtemp(prefix='PlexMALSync-profile-'))
+    with open('settings.ini', 'w') as settings:
+        settings.write(SETTINGS.format(section=SECTION_TITLE, username=MAL_USERNAME, workers=args.workers))
+    plex = OfflinePlex(fixtures, args.latency)
+    plex.install()
+    mal = OfflineMal(fixtures, args.latency)
+    mal.install()
+
+    import PlexMALSync as sync
+    from profiling import StageProfiler
+    sync.logger.setLevel(logging.CRITICAL)
+    if args.anime_db:
+        files = [name for name in ('anime-offline-database.json', 'anime-list.xml')
+                 if name in fixtures.documents]
+        for name in files:
+            with open(name, 'w', encoding='utf-8') as file:
+                file.write(fixtures.documents[name])
+        sync.import_anime_db(files, sync.SyncContext.from_file('settings.ini'))
+
+    context = sync.SyncContext.from_file('settings.ini')
+    profiler = StageProfiler()
+    context.metrics.profiler = profiler
+    sync.start(context=context)
+    plex.uninstall()
+    mal.uninstall()
+
+    for line in profiler.summary(args.top):
+        print(line)
+    collapsed = profiler.save(output)
+    print('Saved the stats to {} and the stacks to {}'.format(output, collapsed))
+
+
+if __name__ == '__main__':
+    main()
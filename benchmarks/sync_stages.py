@@ -0,0 +1,187 @@
+"""
+Times every stage of a sync (PlexMALSync.start()) against the offline Plex server and MAL
+stand-ins of benchmarks/offline.py, for synthetic libraries of several sizes or for a directory
+of recorded responses. Every run starts cold (new state file and MAL cache) in its own process.
+--latency adds a delay to every Plex and MAL request, to compare concurrent and sequential
+requests. With --anime-db the anime-offline-database and HAMA anime-list of the fixtures are imported
+before the sync, so shows are matched by their Plex GUIDs.
+Results are written as JSON so they can be compared between versions.
+
+Usage: python benchmarks/sync_stages.py [--sizes 100,1000,10000] [--fixtures DIR]
+                                        [--save-fixtures DIR] [--workers N] [--latency SECONDS]
+                                        [--anime-db] [--output FILE]
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+
+SETTINGS = '''[PLEX]
+authentication_method = direct
+base_url = http://offline:32400
+token = offline
+anime_section = {section}
+page_size = 1000
+
+[MAL]
+username = {username}
+password = offline
+write_rate = 0
+
+[SYNC]
+state_file = PlexMALSync.db
+workers = {workers}
+'''
+
+
+def run(fixtures, workers, anime_db=False, latency=0):
+    from offline import MAL_USERNAME, SECTION_TITLE, OfflineMal, OfflinePlex
+
+    # The state file is created in the working directory
+    directory = tempfile.mkdtemp(prefix='PlexMALSync-benchmark-')
+    with open(os.path.join(directory, 'settings.ini'), 'w') as settings:
+        settings.write(SETTINGS.format(section=SECTION_TITLE, username=MAL_USERNAME, workers=workers))
+    os.chdir(directory)
+    plex = OfflinePlex(fixtures, latency)
+    plex.install()
+    mal = OfflineMal(fixtures, latency)
+    mal.install()
+
+    started = time.perf_counter()
+    import PlexMALSync as sync
+    from matching import MalListIndex
+    from sync_state import SyncState
+    import_seconds = time.perf_counter() - started
+    sync.logger.setLevel(logging.CRITICAL)
+    context = sync.SyncContext.from_file('settings.ini')
+    if anime_db:
+        files = [name for name in ('anime-offline-database.json', 'anime-list.xml')
+                 if name in fixtures.documents]
+        for name in files:
+            with open(name, 'w', encoding='utf-8') as file:
+                file.write(fixtures.documents[name])
+        sync.import_anime_db(files, context)
+        context = sync.SyncContext.from_file('settings.ini')
+
+    stages = dict()
+
+    def stage(name, func):
+        counters = (plex.requests, plex.bytes, mal.requests, mal.bytes)
+        started = time.perf_counter()
+        result = func()
+        stages[name] = {
+            'seconds': round(time.perf_counter() - started, 6),
+            'plex_requests': plex.requests - counters[0],
+            'plex_bytes': plex.bytes - counters[1],
+            'mal_requests': mal.requests - counters[2],
+            'mal_bytes': mal.bytes - counters[3]}
+        return result
+
+    # Same stages as start() with a full scan
+    state = SyncState('PlexMALSync.db')
+    shows = stage('get_anime_shows', lambda: sync.get_anime_shows(context))
+    watched_shows = stage('get_plex_watched_shows',
+                          lambda: sync.get_plex_watched_shows(context, shows, state, True))
+    mal_list = stage('get_mal_list', lambda: sync.get_mal_list(context))
+    mal_list_seasoned = stage('match_seasons_on_mal_list', lambda: sync.match_seasons_on_mal_list(mal_list))
+    updated_mal_list = stage('update_mal_list_with_seasons',
+                             lambda: sync.update_mal_list_with_seasons(context, mal_list_seasoned, watched_shows))
+    stage('send_watched_to_mal', lambda: sync.send_watched_to_mal(
+        context, watched_shows, MalListIndex(mal_list, updated_mal_list)))
+    state.save(set(str(show.ratingKey) for show in shows))
+    state.close()
+    context.close()
+    plex.uninstall()
+    mal.uninstall()
+
+    return {
+        'shows': len(fixtures.shows),
+        'episodes': len(fixtures.episodes),
+        'watched_shows': len(watched_shows),
+        'mal_list': len(mal_list),
+        'mal_writes': mal.writes,
+        'workers': workers,
+        'anime_db': anime_db,
+        'latency': latency,
+        'import_seconds': round(import_seconds, 6),
+        'total_seconds': round(sum(x['seconds'] for x in stages.values()), 6),
+        'stages': stages}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time the sync stages against offline Plex and MAL fixtures')
+    parser.add_argument(
+        '--sizes', default='100,1000,10000',
+        help='comma separated numbers of shows of the synthetic libraries')
+    parser.add_argument(
+        '--fixtures', metavar='DIR',
+        help='use the recorded responses in DIR instead of synthetic libraries')
+    parser.add_argument(
+        '--save-fixtures', metavar='DIR',
+        help='save the synthetic libraries to DIR/<size> for later runs with --fixtures')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument(
+        '--latency', type=float, default=0,
+        help='seconds every Plex and MAL request takes')
+    parser.add_argument(
+        '--anime-db', action='store_true',
+        help='import the anime-offline-database and anime-list of the fixtures before the sync')
+    parser.add_argument('--output', metavar='FILE', help='write the results to FILE instead of stdout')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        # Single run in a separate process, started below
+        warnings.simplefilter('ignore')
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        from offline import Fixtures
+        if args.fixtures:
+            fixtures = Fixtures.load(args.fixtures)
+        else:
+            fixtures = Fixtures.generate(int(args.run), args.seed)
+            if args.save_fixtures:
+                fixtures.save(os.path.join(args.save_fixtures, args.run))
+        print(json.dumps(run(fixtures, args.workers, args.anime_db, args.latency)))
+        return
+
+    runs = list()
+    for size in ['recorded'] if args.fixtures else args.sizes.split(','):
+        command = [sys.executable, os.path.abspath(__file__), '--run', size.strip(),
+                   '--seed', str(args.seed), '--workers', str(args.workers),
+                   '--latency', str(args.latency)]
+        if args.anime_db:
+            command.append('--anime-db')
+        for option in ('fixtures', 'save_fixtures'):
+            if getattr(args, option):
+                command += ['--' + option.replace('_', '-'), os.path.abspath(getattr(args, option))]
+        output = subprocess.check_output(command, universal_newlines=True)
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+        print('{} shows: {:.2f} seconds'.format(runs[-1]['shows'], runs[-1]['total_seconds']),
+              file=sys.stderr)
+
+    import plexapi
+    results = json.dumps({
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'plexapi': plexapi.VERSION,
+        'runs': runs}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(results + '\n')
+    else:
+        print(results)
+
+
+if __name__ == '__main__':
+    main()
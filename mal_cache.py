@@ -0,0 +1,288 @@
+import html
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+import requests
+import spice_api as spice
+from bs4 import BeautifulSoup
+from lxml import etree
+from spice_api import constants, tokens
+from spice_api.objects import Anime
+from spice_api.spice import user_agent
+from mal_writes import TokenBucket
+from matching import TrigramIndex
+
+logger = logging.getLogger('PlexMALSync')
+
+# Bytes of the MAL list read and parsed at a time
+LIST_CHUNK = 65536
+
+# Titles of a cached entry, without parsing it
+ENTRY_TITLES = re.compile(r'<(?:title|english)>([^<]+)</(?:title|english)>')
+
+# Order of the list statuses in a spice MediumList: watching, completed, on
+# hold, dropped and plan to watch
+LIST_STATUSES = [str(x) for x in (
+    tokens.StatusNumber.WATCHING, tokens.StatusNumber.COMPLETED, tokens.StatusNumber.ONHOLD,
+    tokens.StatusNumber.DROPPED, tokens.StatusNumber.PLANTOWATCH)]
+
+
+class MalCache:
+    """
+    MalCache: on-disk cache for spice.search and spice.search_id results.
+    searches are keyed by normalized query and lookups by MAL id, results of a search also fill the id cache.
+    results are kept for ttl seconds, airing_ttl when a result is still airing and not_found_ttl when nothing was found.
+    find_similar() matches titles against the cached entries without searching MAL.
+    searches and lookups sent to MAL are limited to read_rate per second with bursts of read_burst, 0 is unlimited.
+    """
+
+    def __init__(self, file, credentials, ttl, airing_ttl, not_found_ttl, read_rate=0, read_burst=10):
+        self.credentials = credentials
+        self.bucket = TokenBucket(read_rate, read_burst) if read_rate > 0 else None
+        self.ttl = ttl
+        self.airing_ttl = airing_ttl
+        self.not_found_ttl = not_found_ttl
+        self.hits = 0
+        self.misses = 0
+        self.similar_hits = 0
+        self.similar = None
+        # Shared by worker threads
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file, check_same_thread=False)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS mal_cache (
+                kind TEXT,
+                key TEXT,
+                value TEXT,
+                expires REAL,
+                PRIMARY KEY (kind, key));''')
+
+    def search(self, query):
+        key = ' '.join(query.lower().split())
+        found, entries = self._get('search', key)
+        if found:
+            return self._load(entries)
+        self._wait()
+        results = spice.search(query, spice.get_medium('anime'), self.credentials)
+        self._put('search', key, [str(x.raw_data) for x in results], results)
+        for result in results:
+            self._put('id', result.id, [str(result.raw_data)], [result])
+        return results
+
+    def search_id(self, mal_id):
+        found, entries = self._get('id', str(mal_id))
+        if found:
+            return self._load(entries)[0] if entries else None
+        self._wait()
+        result = spice.search_id(mal_id, spice.get_medium('anime'), self.credentials)
+        if result:
+            self._put('id', str(mal_id), [str(result.raw_data)], [result])
+        else:
+            self._put('id', str(mal_id), None, None)
+        return result
+
+    def find_similar(self, title, threshold):
+        # Cached entry with the most similar title, the index is built on
+        # first use and kept up to date by _put
+        if threshold <= 0:
+            return None
+        with self.lock:
+            if self.similar is None:
+                self.similar = TrigramIndex()
+                rows = self.connection.execute(
+                    "SELECT key, value FROM mal_cache WHERE kind = 'id' AND expires >= ?",
+                    (time.time(),))
+                for key, value in rows:
+                    for entry in json.loads(value) or list():
+                        self._add_similar(int(key), entry)
+            mal_id = self.similar.find(title, threshold)[1]
+            if mal_id is not None:
+                row = self.connection.execute(
+                    "SELECT expires FROM mal_cache WHERE kind = 'id' AND key = ?",
+                    (str(mal_id),)).fetchone()
+                if row is None or row[0] < time.time():
+                    # Expired entry, the index is built again without the
+                    # expired entries on next use
+                    self.similar = None
+                    mal_id = None
+                else:
+                    self.similar_hits += 1
+        return self.search_id(mal_id) if mal_id is not None else None
+
+    def _add_similar(self, mal_id, entry):
+        for title in ENTRY_TITLES.findall(entry):
+            self.similar.add(html.unescape(title), mal_id)
+
+    def _wait(self):
+        if self.bucket is not None:
+            self.bucket.acquire()
+
+    def _get(self, kind, key):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT value, expires FROM mal_cache WHERE kind = ? AND key = ?',
+                (kind, key)).fetchone()
+            if row is None or row[1] < time.time():
+                self.misses += 1
+                return False, None
+            self.hits += 1
+        return True, json.loads(row[0])
+
+    def _put(self, kind, key, entries, results):
+        if not results:
+            ttl = self.not_found_ttl
+        elif any(x.status != 'Finished Airing' for x in results):
+            ttl = self.airing_ttl
+        else:
+            ttl = self.ttl
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO mal_cache VALUES (?, ?, ?, ?)',
+                (kind, key, json.dumps(entries), time.time() + ttl))
+            if kind == 'id' and self.similar is not None:
+                for entry in entries or list():
+                    self._add_similar(int(key), entry)
+
+    @staticmethod
+    def _load(entries):
+        if not entries:
+            return list()
+        soup = BeautifulSoup('<anime>{}</anime>'.format(''.join(entries)), 'lxml')
+        return [Anime(entry) for entry in soup.find_all('entry')]
+
+    def close(self):
+        self.connection.close()
+
+
+class MalEntry:
+    """
+    MalEntry: compact MAL list entry with the same attributes as a spice list Anime,
+    episodes is the watched episode count, anime_type the list series_type (1 is TV).
+    """
+    __slots__ = ('id', 'title', 'english', 'episodes', 'status', 'anime_type', 'start_date')
+
+    def __init__(self, id, title, english, episodes, status, anime_type=None, start_date=None):
+        self.id = id
+        self.title = title
+        self.english = english
+        self.episodes = episodes
+        self.status = status
+        self.anime_type = anime_type
+        self.start_date = start_date
+
+    @classmethod
+    def from_anime(cls, anime):
+        return cls(anime.id, anime.title, anime.english, anime.episodes, anime.status)
+
+    @classmethod
+    def from_element(cls, element):
+        return cls(element.findtext('series_animedb_id'), element.findtext('series_title'), None,
+                   element.findtext('my_watched_episodes'), element.findtext('my_status'),
+                   element.findtext('series_type'), element.findtext('series_start'))
+
+    def to_list(self):
+        return [self.id, self.title, self.english, self.episodes, self.status, self.anime_type,
+                self.start_date]
+
+
+def fetch_mal_list(session, username, retries=3):
+    """
+    fetch_mal_list: MAL anime list of username as MalEntry records in the order of a spice list.
+    the list is parsed while it is downloaded and every entry element is dropped once read.
+    a throttled or failed request is sent again up to retries times.
+    """
+    for attempt in range(retries + 1):
+        response = session.get(constants.ANIMELIST_BASE.format(username),
+                               headers={'User-Agent': user_agent}, stream=True)
+        response.raw.decode_content = True
+        # MAL may answer a throttled request with a page saying so instead of
+        # the list, found in the first chunk before parsing
+        data = response.raw.read(LIST_CHUNK) if response.status_code < 400 else b''
+        throttled = response.status_code == 429 or \
+            constants.TOO_MANY_REQUESTS.encode('utf-8') in data
+        if not throttled and response.status_code < 500:
+            break
+        response.close()
+        error = constants.TOO_MANY_REQUESTS if throttled else response.status_code
+        if attempt == retries:
+            logger.error('[MAL] Failed to retrieve list: {}'.format(error))
+            response.raise_for_status()
+            raise requests.HTTPError(error, response=response)
+        retry_after = response.headers.get('Retry-After')
+        wait = float(retry_after) if retry_after and retry_after.isdigit() else 2 ** attempt
+        logger.warning('[MAL] Retrieving list failed ({}), retrying in {} seconds'.format(error, wait))
+        time.sleep(wait)
+    response.raise_for_status()
+    statuses = {status: list() for status in LIST_STATUSES}
+    parser = etree.XMLPullParser(tag='anime')
+    while True:
+        if data:
+            parser.feed(data)
+        else:
+            parser.close()
+        for event, element in parser.read_events():
+            entry = MalEntry.from_element(element)
+            statuses.setdefault(entry.status, list()).append(entry)
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+        if not data:
+            break
+        data = response.raw.read(LIST_CHUNK)
+    response.close()
+    return [entry for entries in statuses.values() for entry in entries]
+
+
+class MalListSnapshot:
+    """
+    MalListSnapshot: last retrieved MAL list of a user, stored in the local state database
+    so a single show can be updated without retrieving the list.
+    """
+
+    def __init__(self, file):
+        # Shared by the profiles of a multi-profile sync
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file, check_same_thread=False)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS mal_list (
+                username TEXT PRIMARY KEY,
+                entries TEXT,
+                updated REAL);''')
+
+    def load(self, username):
+        # Returns the entries and the age in seconds, or None when there is no snapshot
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT entries, updated FROM mal_list WHERE username = ?',
+                (username.lower(),)).fetchone()
+        if row is None:
+            return None, None
+        return [MalEntry(*x) for x in json.loads(row[0])], time.time() - row[1]
+
+    def save(self, username, mal_list):
+        entries = [x if isinstance(x, MalEntry) else MalEntry.from_anime(x)
+                   for x in mal_list or list()]
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO mal_list VALUES (?, ?, ?)',
+                (username.lower(), json.dumps([x.to_list() for x in entries]), time.time()))
+        return entries
+
+    def update_entry(self, username, entries, mal_id, episodes, status):
+        # Keep the snapshot in line with a list update that was sent
+        entry = next((x for x in entries if int(x.id) == int(mal_id)), None)
+        if entry is None:
+            entry = MalEntry(str(mal_id), '', None, '0', status)
+            entries.append(entry)
+        entry.episodes = str(episodes)
+        entry.status = str(status)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'UPDATE mal_list SET entries = ? WHERE username = ?',
+                (json.dumps([x.to_list() for x in entries]), username.lower()))
+
+    def close(self):
+        self.connection.close()
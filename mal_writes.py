@@ -0,0 +1,191 @@
+import json
+import logging
+import threading
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+import spice_api as spice
+from spice_api import constants, helpers, tokens
+from spice_api.spice import user_agent
+
+logger = logging.getLogger('PlexMALSync')
+
+
+class TokenBucket:
+    """
+    TokenBucket: allows rate requests per second on average with bursts of up to capacity requests.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                time.sleep((1 - self.tokens) / self.rate)
+
+
+class MalWriteQueue:
+    """
+    MalWriteQueue: collects MAL list adds and updates and sends them in one go with flush().
+    operations on the same MAL id are coalesced into one write with the last queued data,
+    as an add when the entry had to be added. writes are rate limited (rate 0 is unlimited) and retried with
+    exponential backoff when MAL throttles (429) or fails (5xx), up to connections writes are sent at the same time.
+    instead of flushing, the pending writes can be saved as a plan with write_plan() and sent later with load_plan().
+    with a journal (sync_state.SyncJournal) every queued write and every sent write is recorded in it.
+    """
+
+    def __init__(self, credentials, rate, burst, retries, session=None, connections=1):
+        self.credentials = credentials
+        self.connections = max(connections, 1)
+        self.bucket = TokenBucket(rate, burst) if rate > 0 else None
+        self.retries = retries
+        self.session = session or requests.Session()
+        self.pending = dict()
+        self.journal = None
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.added = 0
+        self.updated = 0
+        self.failed = 0
+        self.retried = 0
+
+    def add(self, data, mal_id, title=None, reason=None):
+        self._push(tokens.Operations.ADD, data, mal_id, title, reason)
+
+    def update(self, data, mal_id, title=None, reason=None):
+        self._push(tokens.Operations.UPDATE, data, mal_id, title, reason)
+
+    def _push(self, op, data, mal_id, title, reason, journal=True):
+        mal_id = int(mal_id)
+        with self.lock:
+            self.queued += 1
+            pending = self.pending.get(mal_id)
+            reasons = list()
+            if pending:
+                if pending[0] == tokens.Operations.ADD:
+                    op = tokens.Operations.ADD
+                title = title or pending[2]
+                reasons = pending[3]
+            if reason:
+                reasons.append(reason)
+            self.pending[mal_id] = (op, data, title, reasons)
+            if journal and self.journal is not None:
+                self.journal.set_write(
+                    mal_id, 'add' if op == tokens.Operations.ADD else 'update', data.episodes,
+                    data.status or None, title, '; '.join(reasons))
+
+    def write_plan(self, file, mal_index):
+        """
+        write_plan: save the pending writes as JSON lines, with the current state of each entry on the MAL list.
+        """
+        with self.lock:
+            pending = list(self.pending.items())
+            self.pending.clear()
+        with open(file, 'w', encoding='utf-8') as plan:
+            for mal_id, (op, data, title, reasons) in pending:
+                list_item = mal_index.find_by_id(mal_id)
+                plan.write(json.dumps({
+                    'mal_id': mal_id,
+                    'title': title,
+                    'operation': 'add' if op == tokens.Operations.ADD else 'update',
+                    'current_episodes': int(list_item.episodes) if list_item else None,
+                    'current_status': spice.get_status(list_item.status) if list_item else None,
+                    'target_episodes': data.episodes,
+                    'target_status': data.status or None,
+                    'reason': '; '.join(reasons)}) + '\n')
+        logger.info('[MAL] Saved {} planned list updates to {}'.format(len(pending), file))
+
+    def load_plan(self, file):
+        with open(file, encoding='utf-8') as plan:
+            self.load_writes(json.loads(line) for line in plan if line.strip())
+        logger.info('[MAL] Loaded {} planned list updates from {}'.format(len(self.pending), file))
+
+    def load_writes(self, entries, journal=True):
+        # entries: writes in the plan format
+        for entry in entries:
+            data = spice.get_blank(spice.get_medium('anime'))
+            data.episodes = entry['target_episodes']
+            data.status = entry['target_status'] or 0
+            op = tokens.Operations.ADD if entry['operation'] == 'add' else tokens.Operations.UPDATE
+            self._push(op, data, entry['mal_id'], entry['title'], entry['reason'], journal)
+
+    def flush(self):
+        with self.lock:
+            pending = list(self.pending.items())
+            self.pending.clear()
+        if not pending:
+            return True
+        logger.info('[MAL] Sending {} list updates...'.format(len(pending)))
+        failed = self.failed
+
+        def send(item):
+            mal_id, (op, data, title, reasons) = item
+            if self.bucket is not None:
+                self.bucket.acquire()
+            sent = self._send(op, data, mal_id)
+            if sent and self.journal is not None:
+                self.journal.set_sent(mal_id)
+            return sent
+
+        with ThreadPoolExecutor(max_workers=self.connections) as executor:
+            for op in executor.map(send, pending):
+                if op is None:
+                    self.failed += 1
+                elif op == tokens.Operations.ADD:
+                    self.added += 1
+                else:
+                    self.updated += 1
+        logger.info(
+            '[MAL] Sending list updates finished: {} queued, {} added, {} updated, {} failed, {} retries'.format(
+                self.queued, self.added, self.updated, self.failed, self.retried))
+        return self.failed == failed
+
+    def _send(self, op, data, mal_id):
+        # Operation MAL accepted, None when the write failed
+        url = helpers.get_post_url(mal_id, tokens.Medium.ANIME, op) + data.to_xml()
+        headers = {'Content-type': 'application/xml', 'Accept': 'text/plain',
+                   'User-Agent': user_agent}
+        for attempt in range(self.retries + 1):
+            retry_after = None
+            try:
+                # MAL API expects the data in the url of a GET request
+                response = self.session.get(url, headers=headers, auth=self.credentials)
+                throttled = response.status_code == 429 or \
+                    constants.TOO_MANY_REQUESTS in response.text
+                if not throttled and response.status_code < 500:
+                    if response.status_code >= 400 and op == tokens.Operations.ADD:
+                        # Entries taken to be missing from the list may be on
+                        # it, e.g. seasons matched by name
+                        logger.warning('[MAL] Adding list entry {} failed ({} {}), updating it instead'.format(
+                            mal_id, response.status_code, response.text.strip()))
+                        return self._send(tokens.Operations.UPDATE, data, mal_id)
+                    if response.status_code >= 400:
+                        logger.error('[MAL] Failed to write list entry {}: {} {}'.format(
+                            mal_id, response.status_code, response.text.strip()))
+                        return None
+                    return op
+                retry_after = response.headers.get('Retry-After')
+                error = response.status_code
+            except requests.RequestException as e:
+                error = e
+            if attempt == self.retries:
+                logger.error('[MAL] Failed to write list entry {}: {}'.format(mal_id, error))
+                return None
+            with self.lock:
+                self.retried += 1
+            wait = float(retry_after) if retry_after and retry_after.isdigit() else 2 ** attempt
+            logger.warning('[MAL] Writing list entry {} failed ({}), retrying in {} seconds'.format(
+                mal_id, error, wait))
+            time.sleep(wait)
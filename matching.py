@@ -0,0 +1,266 @@
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import deque
+from functools import lru_cache
+
+# Titles memoized by normalize_title and title_key, a library and MAL list
+# rarely have more distinct titles than this
+TITLE_CACHE_SIZE = 16384
+
+# Season suffixes of normalized titles => season, e.g. "2nd season",
+# "season 2", "part 2" and "ii" are all season 2
+SEASON_NUMBERS = {'first': 1, 'second': 2, 'third': 3, 'fourth': 4, 'fifth': 5, 'sixth': 6,
+                  'ii': 2, 'iii': 3, 'iv': 4}
+SEASON_SUFFIXES = [re.compile(pattern) for pattern in (
+    r'^(.+) (?:season|part|cour) (\d{1,2})$',
+    r'^(.+) (\d{1,2})(?:st|nd|rd|th) (?:season|part|cour)$',
+    r'^(.+) (first|second|third|fourth|fifth|sixth) (?:season|stage)$',
+    r'^(.+?) (?:the )?(final)(?: season)?$',
+    r'^(.+) (ii|iii|iv)$',
+    r'^(.+) (\d{1,2})$')]
+
+# HAMA agent show GUIDs, e.g. com.plexapp.agents.hama://anidb-9541?lang=en,
+# tvdb2-4 use absolute episode numbering and are not matched by season
+HAMA_GUID = re.compile(r'^com\.plexapp\.agents\.hama://(anidb|tvdb)-(\d+)')
+
+
+def count_containing(patterns, texts):
+    """
+    count_containing: for every pattern the number of texts containing it as a substring.
+    uses an Aho-Corasick automaton over the patterns so every text is scanned once,
+    instead of comparing every pattern against every text.
+    """
+    goto = [dict()]
+    fail = [0]
+    terminal = [False]
+    pattern_nodes = list()
+    for pattern in patterns:
+        node = 0
+        for char in pattern:
+            child = goto[node].get(char)
+            if child is None:
+                child = len(goto)
+                goto.append(dict())
+                fail.append(0)
+                terminal.append(False)
+                goto[node][char] = child
+            node = child
+        terminal[node] = True
+        pattern_nodes.append(node)
+
+    # Link every node to the nearest pattern ending in its longest proper
+    # suffix so all patterns ending at a text position are found
+    output = [0] * len(goto)
+    queue = deque(goto[0].values())
+    while queue:
+        node = queue.popleft()
+        for char, child in goto[node].items():
+            state = fail[node]
+            while state and char not in goto[state]:
+                state = fail[state]
+            fail[child] = goto[state].get(char, 0)
+            output[child] = fail[child] if terminal[fail[child]] else output[fail[child]]
+            queue.append(child)
+
+    counts = [0] * len(goto)
+    for text in texts:
+        found = set()
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            match = node if terminal[node] else output[node]
+            while match and match not in found:
+                found.add(match)
+                match = output[match]
+        for match in found:
+            counts[match] += 1
+
+    # An empty pattern is contained in every text
+    return [counts[node] if node else len(texts) for node in pattern_nodes]
+
+
+@lru_cache(maxsize=TITLE_CACHE_SIZE)
+def normalize_title(title):
+    """
+    normalize_title: casefolded title with punctuation and repeated whitespace replaced by a single space,
+    e.g. "Re:ZERO -Starting Life-" => "re zero starting life".
+    """
+    title = unicodedata.normalize('NFKC', title or '').casefold()
+    return ' '.join(re.sub(r'[\W_]+', ' ', title).split())
+
+
+@lru_cache(maxsize=TITLE_CACHE_SIZE)
+def title_key(title):
+    """
+    title_key: (title without season suffix, season) of a title, the season is '' for titles
+    without one, so "Title 2nd Season", "Title Season 2" and "Title II" all compare equal.
+    "!!" is kept apart as a season as it usually is the only difference with the first season.
+    """
+    normalized = normalize_title(title)
+    if (title or '').rstrip().endswith('!!'):
+        return normalized, '!!'
+    for pattern in SEASON_SUFFIXES:
+        match = pattern.match(normalized)
+        if match:
+            base, season = match.groups()
+            season = SEASON_NUMBERS.get(season, season)
+            if season != 'final':
+                season = str(int(season)) if int(season) != 1 else ''
+            return base, season
+    return normalized, ''
+
+
+def parse_guid(guid):
+    """
+    parse_guid: (source, id) of a HAMA agent GUID, e.g. ('anidb', '9541'), None for other agents.
+    """
+    match = HAMA_GUID.match(guid or '')
+    return match.groups() if match else None
+
+
+def trigrams(text):
+    # Character trigrams of a normalized title, padded so short titles and
+    # word starts count too
+    text = '  {} '.format(text)
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+class TrigramIndex:
+    """
+    TrigramIndex: fuzzy title lookup, an inverted index from character trigrams of titles (without
+    season suffix) to items. candidates sharing trigrams with a title are scored by Dice similarity,
+    only items with the same season suffix and numbers as the title are returned, as titles differing
+    in a number are different shows.
+    """
+
+    def __init__(self):
+        self.items = list()
+        self.grams = dict()
+
+    def add(self, title, item):
+        base, season = title_key(title)
+        grams = trigrams(base)
+        number = len(self.items)
+        self.items.append((grams, (season, re.findall(r'\d+', base)), item))
+        for gram in grams:
+            self.grams.setdefault(gram, list()).append(number)
+
+    def find(self, title, threshold):
+        # Best (similarity, item) with a similarity of at least threshold,
+        # (0, None) when nothing is similar enough
+        base, season = title_key(title)
+        grams = trigrams(base)
+        kind = (season, re.findall(r'\d+', base))
+        shared = dict()
+        for gram in grams:
+            for number in self.grams.get(gram, ()):
+                shared[number] = shared.get(number, 0) + 1
+        best = (0, None)
+        for number, count in shared.items():
+            item_grams, item_kind, item = self.items[number]
+            if item_kind != kind:
+                continue
+            similarity = 2.0 * count / (len(grams) + len(item_grams))
+            if similarity >= threshold and similarity > best[0]:
+                best = (similarity, item)
+        return best
+
+
+class ParsedTitles:
+    """
+    ParsedTitles: show titles guessed by guessit from Plex titles, kept in the local state database
+    as library titles rarely change and guessit is slow.
+    """
+
+    def __init__(self, file):
+        self.misses = 0
+        # Shared by worker threads
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file, check_same_thread=False)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS parsed_titles (
+                title TEXT PRIMARY KEY,
+                parsed TEXT);''')
+        self.titles = dict(self.connection.execute('SELECT * FROM parsed_titles'))
+
+    def parse(self, title):
+        parsed = self.titles.get(title)
+        if parsed is None:
+            from guessit import guessit
+            parsed = str(guessit(title).get('title', title))
+            with self.lock, self.connection:
+                self.misses += 1
+                self.titles[title] = parsed
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO parsed_titles VALUES (?, ?)', (title, parsed))
+        return parsed
+
+    def close(self):
+        self.connection.close()
+
+
+class MalListIndex:
+    """
+    MalListIndex: lookups into the MAL list, built once per run so matching a show does not scan the list.
+    titles    - title_key of the title or english title => list entries, in list order
+    ids       - MAL id => first list entry
+    originals - normalized original name => first (anime, season, original_name, on_mal_list) entry
+    seasons   - (original_name, season) => first anime
+    similar   - trigram index of the titles and english titles, for titles that do not match exactly
+    seasoned entries found later can be added with extend().
+    """
+
+    def __init__(self, mal_list, mal_list_seasoned=()):
+        self.mal_list = mal_list or list()
+        self.mal_list_seasoned = list()
+        self.titles = dict()
+        self.ids = dict()
+        self.originals = dict()
+        self.seasons = dict()
+        self.season_titles = set()
+        self.similar = TrigramIndex()
+        for item in self.mal_list:
+            keys = list()
+            for title in (item.title, item.english):
+                key = title_key(title) if title else None
+                # Missing or empty titles, e.g. of entries added to a snapshot,
+                # would match every other empty title
+                if key and key[0] and key not in keys:
+                    keys.append(key)
+            for key in keys:
+                self.titles.setdefault(key, list()).append(item)
+            self.similar.add(item.title, item)
+            if item.english:
+                self.similar.add(item.english, item)
+            self.ids.setdefault(int(item.id), item)
+        self.extend(mal_list_seasoned)
+
+    def extend(self, mal_list_seasoned):
+        for entry in mal_list_seasoned:
+            anime, season, original_name = entry[0], entry[1], entry[2]
+            self.mal_list_seasoned.append(entry)
+            self.originals.setdefault(normalize_title(original_name), entry)
+            self.seasons.setdefault((original_name, season), anime)
+            self.season_titles.add((normalize_title(original_name), season))
+
+    def find_by_title(self, title):
+        return self.titles.get(title_key(title), list())
+
+    def find_similar(self, title, threshold):
+        return self.similar.find(title, threshold)[1] if threshold > 0 else None
+
+    def find_by_id(self, mal_id):
+        return self.ids.get(int(mal_id))
+
+    def find_original(self, title):
+        return self.originals.get(normalize_title(title))
+
+    def find_season(self, original_name, season):
+        return self.seasons.get((original_name, season))
+
+    def has_season(self, title, season):
+        return (normalize_title(title), season) in self.season_titles
@@ -0,0 +1,164 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+HOSTS = ('plex', 'mal')
+
+
+class Metrics:
+    """
+    Metrics: wall time, requests, bytes, cache hits and retries of every stage of a sync.
+    requests are counted with response hooks per host, counters of other objects are read
+    at the start and end of a stage after registering them with watch().
+    labels are added to every exported metric, e.g. the profile of a multi-profile sync.
+    a profiler (profiling.StageProfiler) is started and stopped with every stage.
+    """
+
+    def __init__(self, labels=None):
+        self.labels = OrderedDict(sorted((labels or dict()).items()))
+        self.lock = threading.Lock()
+        self.counters = OrderedDict()
+        for host in HOSTS:
+            self.counters['{}_requests'.format(host)] = 0
+            self.counters['{}_bytes'.format(host)] = 0
+            self.counters['{}_seconds'.format(host)] = 0.0
+        self.sources = list()
+        self.stages = OrderedDict()
+        self.started = time.time()
+        self.profiler = None
+
+    def watch(self, source, **attributes):
+        # attributes: counter name => attribute of source, e.g. cache_hits='hits'
+        for name in attributes:
+            self.counters.setdefault(name, 0)
+        self.sources.append((source, attributes))
+
+    def response_hook(self, host):
+        def hook(response, *args, **kwargs):
+            with self.lock:
+                self.counters['{}_requests'.format(host)] += 1
+                if response.elapsed is not None:
+                    self.counters['{}_seconds'.format(host)] += response.elapsed.total_seconds()
+            if kwargs.get('stream'):
+                # Reading the content here would download the body before the
+                # caller streams it, the bytes are counted as they are read
+                response.raw = CountedStream(response.raw, lambda size: self.add('{}_bytes'.format(host), size))
+            else:
+                self.add('{}_bytes'.format(host), len(response.content or b''))
+            return response
+        return hook
+
+    def add(self, name, value):
+        with self.lock:
+            self.counters[name] += value
+
+    def snapshot(self):
+        with self.lock:
+            counters = OrderedDict(self.counters)
+        for source, attributes in self.sources:
+            for name, attribute in attributes.items():
+                counters[name] = getattr(source, attribute)
+        return counters
+
+    def stage(self, name):
+        return Stage(self, name)
+
+    def summary(self):
+        lines = list()
+        for name, stage in list(self.stages.items()) + [('total', self.total())]:
+            lines.append(
+                '{}: {:.2f}s, Plex {} requests ({:.1f} KB), MAL {} requests ({:.1f} KB), '
+                'search cache {} hits {} misses, {} retries'.format(
+                    name, stage['seconds'], stage['plex_requests'], stage['plex_bytes'] / 1024,
+                    stage['mal_requests'], stage['mal_bytes'] / 1024, stage.get('cache_hits', 0),
+                    stage.get('cache_misses', 0), stage.get('retries', 0)))
+        return lines
+
+    def total(self):
+        total = OrderedDict(seconds=0.0)
+        for stage in self.stages.values():
+            for name, value in stage.items():
+                total[name] = total.get(name, 0) + value
+        for name in self.counters:
+            total.setdefault(name, 0)
+        return total
+
+    def export(self, file):
+        """
+        export: write the stages to file, in the Prometheus text format (for the node exporter
+        textfile collector) when file ends with .prom, as JSON otherwise.
+        """
+        if file.endswith('.prom'):
+            lines = list()
+            labels = ''.join('{}="{}",'.format(label, value) for label, value in self.labels.items())
+            names = ['seconds'] + list(self.counters)
+            for name in names:
+                metric = 'plexmalsync_stage_{}'.format(name)
+                lines.append('# TYPE {} gauge'.format(metric))
+                for stage, values in self.stages.items():
+                    lines.append('{}{{{}stage="{}"}} {}'.format(metric, labels, stage, values.get(name, 0)))
+            lines.append('# TYPE plexmalsync_last_run_timestamp_seconds gauge')
+            lines.append('plexmalsync_last_run_timestamp_seconds{} {}'.format(
+                '{{{}}}'.format(labels.rstrip(',')) if labels else '', int(self.started)))
+            data = '\n'.join(lines) + '\n'
+        else:
+            data = dict(self.labels)
+            data.update({'started': int(self.started), 'stages': self.stages, 'total': self.total()})
+            data = json.dumps(data, indent=2) + '\n'
+        # Replace at once so a collector never reads a partial file
+        temporary = '{}.tmp'.format(file)
+        with open(temporary, 'w') as output:
+            output.write(data)
+        os.replace(temporary, file)
+
+
+class CountedStream:
+    """
+    CountedStream: raw stream of a streamed response passing the size of everything read to count.
+    other attributes, e.g. decode_content, are those of the wrapped stream.
+    """
+
+    def __init__(self, raw, count):
+        self.__dict__['_raw'] = raw
+        self.__dict__['_count'] = count
+
+    def read(self, *args, **kwargs):
+        data = self._raw.read(*args, **kwargs)
+        self._count(len(data or b''))
+        return data
+
+    def stream(self, *args, **kwargs):
+        for data in self._raw.stream(*args, **kwargs):
+            self._count(len(data))
+            yield data
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._raw, name, value)
+
+
+class Stage:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.counters = self.metrics.snapshot()
+        if self.metrics.profiler is not None:
+            self.metrics.profiler.start(self.name)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.started
+        if self.metrics.profiler is not None:
+            self.metrics.profiler.stop()
+        counters = self.metrics.snapshot()
+        stage = OrderedDict(seconds=round(seconds, 6))
+        for name, value in counters.items():
+            stage[name] = round(value - self.counters.get(name, 0), 6)
+        self.metrics.stages[self.name] = stage
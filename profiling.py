@@ -0,0 +1,109 @@
+import cProfile
+import os
+import pstats
+import sys
+import threading
+from collections import Counter, OrderedDict
+
+
+class StageProfiler:
+    """
+    StageProfiler: profiles the stages of a sync, started and stopped by the Metrics stages it is attached to.
+    every stage is profiled with cProfile in all threads, for pstats and the hot functions of the stage,
+    while the stacks of all threads are sampled every interval seconds for flame graphs.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stage = None
+        self.profiles = list()
+        self.stats = OrderedDict()
+        self.stacks = Counter()
+        self.sampler = None
+        self.stopped = threading.Event()
+
+    def start(self, stage):
+        self.stage = stage
+        self.stopped.clear()
+        self.sampler = threading.Thread(target=self._sample, name='StageProfiler', daemon=True)
+        self.sampler.start()
+        # Threads started during the stage, e.g. by process_shows(), are
+        # profiled as well
+        threading.setprofile(self._profile_thread)
+        self._enable()
+
+    def stop(self):
+        threading.setprofile(None)
+        self.stopped.set()
+        self.sampler.join()
+        with self.lock:
+            profiles, self.profiles = self.profiles, list()
+        stats = pstats.Stats()
+        for profile in profiles:
+            profile.disable()
+            stats.add(profile)
+        self.stats[self.stage] = stats
+        self.stage = None
+
+    def _enable(self):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Since Python 3.12 one profile covers all threads
+            return
+        with self.lock:
+            self.profiles.append(profile)
+
+    def _profile_thread(self, frame, event, arg):
+        sys.setprofile(None)
+        self._enable()
+
+    def _sample(self):
+        sampler = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == sampler:
+                    continue
+                stack = list()
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{} ({}:{})'.format(
+                        code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, 'Thread'))
+                stack.append(self.stage)
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def summary(self, top=5):
+        # Functions taking the most time of every stage, without the
+        # functions they call
+        lines = list()
+        for stage, stats in self.stats.items():
+            functions = [(values[2], values[1], function) for function, values in stats.stats.items()
+                         if function[0] != self._sample.__code__.co_filename]
+            functions.sort(reverse=True)
+            lines.append('{}: {:.2f}s in {} calls of all threads'.format(
+                stage, stats.total_tt, stats.total_calls))
+            for seconds, calls, (file, line, name) in functions[:top]:
+                lines.append('  {:.3f}s {} calls {}'.format(
+                    seconds, calls, pstats.func_std_string((os.path.basename(file), line, name))))
+        return lines
+
+    def save(self, file):
+        """
+        save: write the stats of all stages to file (pstats, e.g. for snakeviz) and the sampled stacks,
+        one line per stack starting with the stage and thread, to file with the extension .collapsed
+        (for flamegraph.pl, speedscope or inferno).
+        """
+        stats = pstats.Stats()
+        for stage_stats in self.stats.values():
+            stats.add(stage_stats)
+        stats.dump_stats(file)
+        collapsed = '{}.collapsed'.format(os.path.splitext(file)[0])
+        with open(collapsed, 'w', encoding='utf-8') as output:
+            for stack, samples in sorted(self.stacks.items()):
+                output.write('{} {}\n'.format(stack, samples))
+        return collapsed
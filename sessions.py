@@ -0,0 +1,48 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class TimeoutAdapter(HTTPAdapter):
+    """
+    TimeoutAdapter: connection pool that applies the configured timeout to every request,
+    plexapi always passes its own and spice_api none.
+    """
+
+    def __init__(self, timeout, **kwargs):
+        self.timeout = timeout
+        super(TimeoutAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        kwargs['timeout'] = self.timeout
+        return super(TimeoutAdapter, self).send(request, **kwargs)
+
+
+class SessionRequests:
+    """
+    SessionRequests: stand-in for the requests module sending get requests through a session.
+    used for libraries calling requests.get directly, like spice_api.
+    """
+
+    def __init__(self, session):
+        self.session = session
+
+    def get(self, url, **kwargs):
+        return self.session.get(url, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+
+def create_session(pool_size, timeout, keep_alive=True):
+    """
+    create_session: requests session keeping up to pool_size connections per host open between
+    requests (unless keep_alive is off) and accepting compressed responses.
+    """
+    session = requests.Session()
+    adapter = TimeoutAdapter(timeout, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+    return session
@@ -0,0 +1,237 @@
+import sqlite3
+import threading
+
+
+class SyncState:
+    """
+    SyncState: local state persisted between runs in a SQLite database.
+    stores the watermark (latest Plex lastViewedAt/updatedAt seen) of the last successful sync
+    and the computed (episodes_watched, season_watched) tuple for every show.
+    changes are kept in memory and only written by save() once a sync finished, rollback() drops them.
+    """
+
+    def __init__(self, file):
+        self.connection = sqlite3.connect(file)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS sync (
+                key TEXT PRIMARY KEY,
+                value TEXT);
+            CREATE TABLE IF NOT EXISTS shows (
+                rating_key TEXT PRIMARY KEY,
+                title TEXT,
+                episodes_watched INTEGER,
+                season_watched INTEGER);''')
+        self.rollback()
+
+    def rollback(self):
+        # Back to the state saved by the last successful sync
+        row = self.connection.execute(
+            'SELECT value FROM sync WHERE key = ?', ('watermark',)).fetchone()
+        self.watermark = int(row[0]) if row else None
+        self.new_watermark = self.watermark
+        self.shows = {
+            rating_key: (title, (episodes_watched, season_watched))
+            for rating_key, title, episodes_watched, season_watched
+            in self.connection.execute('SELECT * FROM shows')}
+
+    def get_show(self, rating_key):
+        show = self.shows.get(rating_key)
+        return show[1] if show else None
+
+    def set_show(self, rating_key, title, watched):
+        self.shows[rating_key] = (title, watched)
+
+    def update_watermark(self, timestamp):
+        if timestamp and (self.new_watermark is None or timestamp > self.new_watermark):
+            self.new_watermark = timestamp
+
+    def save(self, rating_keys=None):
+        # Shows no longer in the library are dropped
+        if rating_keys is not None:
+            self.shows = {key: value for key, value in self.shows.items()
+                          if key in rating_keys}
+        with self.connection:
+            self.connection.execute('DELETE FROM shows')
+            self.connection.executemany(
+                'INSERT INTO shows VALUES (?, ?, ?, ?)',
+                [(key, title, watched[0], watched[1])
+                 for key, (title, watched) in self.shows.items()])
+            if self.new_watermark is not None:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO sync VALUES (?, ?)',
+                    ('watermark', str(self.new_watermark)))
+        self.watermark = self.new_watermark
+
+    def close(self):
+        self.connection.close()
+
+
+class SyncJournal:
+    """
+    SyncJournal: progress of the running sync, so a sync that stopped halfway is resumed instead of repeated.
+    stores every show matched to MAL with the list writes queued for it and whether each write was sent,
+    and the MAL list entries it matched that needed no write.
+    a show and its writes are committed at once when the show is done, compact() removes everything
+    that was sent once a sync finished, writes that failed are kept and sent by the next sync.
+    shows matched to MAL whose writes were all sent are kept as pushed, with the MAL entries they were
+    sent to or matched, so the next sync skips them while neither Plex nor those entries changed.
+    """
+
+    def __init__(self, file):
+        # Shows are matched and writes sent by worker threads
+        self.lock = threading.Lock()
+        self.current = threading.local()
+        self.connection = sqlite3.connect(file, check_same_thread=False)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS journal_shows (
+                rating_key TEXT PRIMARY KEY,
+                title TEXT,
+                episodes_watched INTEGER,
+                season_watched INTEGER);
+            CREATE TABLE IF NOT EXISTS journal_writes (
+                mal_id INTEGER PRIMARY KEY,
+                rating_key TEXT,
+                operation TEXT,
+                episodes INTEGER,
+                status TEXT,
+                title TEXT,
+                reason TEXT,
+                sent INTEGER);
+            CREATE TABLE IF NOT EXISTS journal_matches (
+                rating_key TEXT,
+                mal_id INTEGER,
+                episodes INTEGER,
+                status TEXT,
+                PRIMARY KEY (rating_key, mal_id));
+            CREATE TABLE IF NOT EXISTS pushed_shows (
+                rating_key TEXT PRIMARY KEY,
+                episodes_watched INTEGER,
+                season_watched INTEGER);
+            CREATE TABLE IF NOT EXISTS pushed_writes (
+                rating_key TEXT,
+                mal_id INTEGER,
+                episodes INTEGER,
+                status TEXT,
+                PRIMARY KEY (rating_key, mal_id));''')
+        self.pushed = dict()
+        for rating_key, episodes_watched, season_watched in self.connection.execute(
+                'SELECT * FROM pushed_shows'):
+            self.pushed[rating_key] = ((episodes_watched, season_watched), list())
+        for rating_key, mal_id, episodes, status in self.connection.execute('SELECT * FROM pushed_writes'):
+            if rating_key in self.pushed:
+                self.pushed[rating_key][1].append((mal_id, episodes, status))
+        self.shows = {
+            rating_key: (episodes_watched, season_watched)
+            for rating_key, episodes_watched, season_watched in self.connection.execute(
+                'SELECT rating_key, episodes_watched, season_watched FROM journal_shows')}
+
+    def get_show(self, rating_key):
+        # (episodes_watched, season_watched) the show was matched with, None when it was not
+        return self.shows.get(rating_key)
+
+    def is_pushed(self, rating_key, watched, mal_entries):
+        """
+        is_pushed: whether the show was sent with the same watch state and the MAL entries it was sent to
+        still have the episodes and status sent, mal_entries is a dict of MAL id => (episodes, status).
+        """
+        pushed = self.pushed.get(rating_key)
+        if pushed is None or not pushed[1] or pushed[0] != tuple(watched):
+            return False
+        for mal_id, episodes, status in pushed[1]:
+            entry = mal_entries.get(mal_id)
+            if entry is None or entry[0] != episodes or (status and entry[1] != status):
+                return False
+        return True
+
+    def begin_show(self, rating_key):
+        # Writes queued and matches set by this thread until end_show() belong
+        # to the show
+        self.current.rating_key = rating_key
+        self.current.writes = list()
+        self.current.matches = list()
+
+    def end_show(self, title, watched):
+        # Earlier writes of the show that were not sent are replaced
+        rating_key = self.current.rating_key
+        writes = self.current.writes
+        matches = self.current.matches
+        self.current.rating_key = self.current.writes = self.current.matches = None
+        with self.lock, self.connection:
+            self.connection.execute(
+                'DELETE FROM journal_writes WHERE rating_key = ? AND sent = 0', (rating_key,))
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO journal_writes VALUES (?, ?, ?, ?, ?, ?, ?, 0)', writes)
+            self.connection.execute('DELETE FROM journal_matches WHERE rating_key = ?', (rating_key,))
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO journal_matches VALUES (?, ?, ?, ?)', matches)
+            self.connection.execute(
+                'INSERT OR REPLACE INTO journal_shows VALUES (?, ?, ?, ?)',
+                (rating_key, title, watched[0], watched[1]))
+
+    def set_write(self, mal_id, operation, episodes, status, title, reason):
+        write = (mal_id, getattr(self.current, 'rating_key', None), operation, episodes, status, title, reason)
+        if write[1] is not None:
+            self.current.writes.append(write)
+            return
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO journal_writes VALUES (?, ?, ?, ?, ?, ?, ?, 0)', write)
+
+    def set_match(self, mal_id, episodes, status):
+        # MAL list entry the current show matched without needing a write
+        if getattr(self.current, 'rating_key', None) is not None:
+            self.current.matches.append((self.current.rating_key, mal_id, episodes, status))
+
+    def set_sent(self, mal_id):
+        with self.lock, self.connection:
+            self.connection.execute('UPDATE journal_writes SET sent = 1 WHERE mal_id = ?', (mal_id,))
+
+    def pending_writes(self, rematched=()):
+        # Writes of matched shows that were not sent, in the plan format of MalWriteQueue,
+        # except those of the rematched shows
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT rating_key, mal_id, operation, episodes, status, title, reason FROM journal_writes '
+                'WHERE sent = 0 AND rating_key IN (SELECT rating_key FROM journal_shows)').fetchall()
+        return [{'mal_id': mal_id, 'operation': operation, 'target_episodes': episodes,
+                 'target_status': status, 'title': title, 'reason': reason}
+                for rating_key, mal_id, operation, episodes, status, title, reason in rows
+                if rating_key not in rematched]
+
+    def compact(self):
+        # Only shows with writes still to send are kept, writes of shows that
+        # were not done are queued again when the show is matched. Shows that
+        # matched nothing on MAL are not pushed so the next sync tries again
+        with self.lock, self.connection:
+            done = '''SELECT rating_key FROM journal_shows WHERE rating_key NOT IN
+                      (SELECT rating_key FROM journal_writes WHERE sent = 0 AND rating_key IS NOT NULL)
+                      AND (rating_key IN (SELECT rating_key FROM journal_matches)
+                      OR rating_key IN (SELECT rating_key FROM journal_writes WHERE sent = 1))'''
+            self.connection.execute(
+                'DELETE FROM pushed_shows WHERE rating_key IN (SELECT rating_key FROM journal_shows)')
+            self.connection.execute(
+                'DELETE FROM pushed_writes WHERE rating_key IN (SELECT rating_key FROM journal_shows)')
+            self.connection.execute(
+                '''INSERT OR REPLACE INTO pushed_shows SELECT rating_key, episodes_watched, season_watched
+                   FROM journal_shows WHERE rating_key IN ({})'''.format(done))
+            # A write sent to an entry replaces the state it was matched with
+            self.connection.execute(
+                '''INSERT OR REPLACE INTO pushed_writes SELECT rating_key, mal_id, episodes, status
+                   FROM journal_matches WHERE rating_key IN ({})'''.format(done))
+            self.connection.execute(
+                '''INSERT OR REPLACE INTO pushed_writes SELECT rating_key, mal_id, episodes, status
+                   FROM journal_writes WHERE sent = 1 AND rating_key IN ({})'''.format(done))
+            self.connection.execute('DELETE FROM journal_writes WHERE sent = 1')
+            self.connection.execute(
+                'DELETE FROM journal_writes WHERE rating_key NOT IN (SELECT rating_key FROM journal_shows)')
+            self.connection.execute(
+                '''DELETE FROM journal_shows WHERE rating_key NOT IN
+                   (SELECT rating_key FROM journal_writes WHERE rating_key IS NOT NULL)''')
+            self.connection.execute(
+                'DELETE FROM journal_matches WHERE rating_key NOT IN (SELECT rating_key FROM journal_shows)')
+            self.shows = {
+                rating_key: (episodes_watched, season_watched)
+                for rating_key, episodes_watched, season_watched in self.connection.execute(
+                    'SELECT rating_key, episodes_watched, season_watched FROM journal_shows')}
+
+    def close(self):
+        self.connection.close()
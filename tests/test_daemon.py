@@ -0,0 +1,104 @@
+import configparser
+import types
+
+import pytest
+
+import PlexMALSync as sync
+from sync_state import SyncState
+
+
+class Show:
+    # Plex shows are dict keys of the watched shows
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+class Listener:
+    def __init__(self, alive):
+        self.alive = alive
+
+    def is_alive(self):
+        return self.alive
+
+    def stop(self):
+        self.alive = False
+
+
+class Plex:
+    def __init__(self):
+        # The first listener drops its connection right away
+        self.listeners = list()
+        self.library = types.SimpleNamespace(
+            section=lambda name: types.SimpleNamespace(key='1'))
+
+    def startAlertListener(self, callback):
+        self.listeners.append(Listener(alive=bool(self.listeners)))
+        return self.listeners[-1]
+
+
+@pytest.fixture
+def context(monkeypatch, tmp_path):
+    settings = configparser.ConfigParser()
+    settings.read_dict({
+        'PLEX': {'anime_section': 'Anime'},
+        'SYNC': {'state_file': str(tmp_path / 'PlexMALSync.db'),
+                 'refresh_interval': '0.0001', 'event_delay': '0'}})
+    plex = Plex()
+    monkeypatch.setattr(sync.SyncContext, 'plex', property(lambda self: plex))
+    return sync.SyncContext(settings)
+
+
+def test_failed_refresh_is_sent_again(monkeypatch, context):
+    show = Show(ratingKey=1, title='Show')
+    refreshes = list()
+    sent = list()
+
+    def get_anime_shows(context):
+        refreshes.append(None)
+        if len(refreshes) > 2:
+            raise KeyboardInterrupt
+        return [show]
+
+    def get_plex_watched_shows(context, shows, state, full):
+        state.set_show('1', show.title, (4, 1))
+        state.update_watermark(100)
+        return {show: (4, 1)}
+
+    def sync_watched_shows(context, watched_shows, mal_index):
+        sent.append(dict(watched_shows))
+        if len(sent) == 1:
+            raise RuntimeError('MAL is unreachable')
+
+    monkeypatch.setattr(sync, 'get_anime_shows', get_anime_shows)
+    monkeypatch.setattr(sync, 'get_plex_watched_shows',
+                        get_plex_watched_shows)
+    monkeypatch.setattr(sync, 'get_mal_list', lambda context: list())
+    monkeypatch.setattr(sync, 'sync_watched_shows', sync_watched_shows)
+    sync.daemon(context)
+
+    assert sent == [{show: (4, 1)}, {show: (4, 1)}]
+    state = SyncState(context.state_file)
+    assert state.get_show('1') == (4, 1)
+    assert state.watermark == 100
+    state.close()
+    # The listener that stopped was started again
+    assert len(context.plex.listeners) == 2
+
+
+def test_failed_event_sync_keeps_state(monkeypatch, context):
+    show = Show(ratingKey=1, title='Show', type='show', librarySectionID=1)
+    episode = types.SimpleNamespace(
+        type='episode', librarySectionID=1, grandparentRatingKey=1)
+    context.plex.fetchItem = lambda key: episode if key == 11 else show
+    monkeypatch.setattr(sync, 'get_show_episodes',
+                        lambda show: [(1, 1, True), (1, 2, True)])
+
+    def sync_watched_shows(context, watched_shows, mal_index):
+        raise RuntimeError('MAL is unreachable')
+
+    monkeypatch.setattr(sync, 'sync_watched_shows', sync_watched_shows)
+    state = SyncState(context.state_file)
+    with pytest.raises(RuntimeError):
+        sync.sync_rating_keys(context, {'11'}, '1', state, None)
+    assert state.get_show('1') is None
+    state.close()
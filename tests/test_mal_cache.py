@@ -0,0 +1,111 @@
+import io
+import json
+import time
+
+import pytest
+import requests
+
+import mal_cache
+from mal_cache import MalCache, fetch_mal_list
+
+MAL_LIST = (
+    '<?xml version="1.0" encoding="UTF-8"?><myanimelist>'
+    '<anime><series_animedb_id>1</series_animedb_id>'
+    '<series_title>Title</series_title><series_type>1</series_type>'
+    '<series_episodes>12</series_episodes>'
+    '<my_watched_episodes>3</my_watched_episodes>'
+    '<my_status>1</my_status></anime>'
+    '<anime><series_animedb_id>2</series_animedb_id>'
+    '<series_title>Other</series_title><series_type>1</series_type>'
+    '<series_episodes>24</series_episodes>'
+    '<my_watched_episodes>24</my_watched_episodes>'
+    '<my_status>2</my_status></anime></myanimelist>')
+
+
+class Response:
+    def __init__(self, status_code, text, headers=None):
+        self.status_code = status_code
+        self.raw = io.BytesIO(text.encode('utf-8'))
+        self.headers = headers or dict()
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(self.status_code)
+
+    def close(self):
+        pass
+
+
+class Session:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = 0
+
+    def get(self, url, **kwargs):
+        self.requests += 1
+        return self.responses.pop(0)
+
+
+def put_entry(cache, mal_id, title, expires):
+    entry = '<entry><id>{}</id><title>{}</title></entry>'.format(
+        mal_id, title)
+    with cache.connection:
+        cache.connection.execute(
+            'INSERT OR REPLACE INTO mal_cache VALUES (?, ?, ?, ?)',
+            ('id', str(mal_id), json.dumps([entry]), expires))
+
+
+def test_find_similar_returns_cached_entry(tmp_path, monkeypatch):
+    monkeypatch.setattr(mal_cache.spice, 'search_id', None)
+    cache = MalCache(str(tmp_path / 'cache.db'), None, 60, 60, 60)
+    put_entry(cache, 123, 'Shingeki no Kyojin', time.time() + 60)
+    found = cache.find_similar('Shingeki no Kyojinn', 0.8)
+    assert found.id == '123'
+    assert cache.similar_hits == 1
+    cache.close()
+
+
+def test_find_similar_ignores_expired_entries(tmp_path, monkeypatch):
+    lookups = list()
+    monkeypatch.setattr(mal_cache.spice, 'search_id',
+                        lambda mal_id, *args: lookups.append(mal_id))
+    cache = MalCache(str(tmp_path / 'cache.db'), None, 60, 60, 60)
+    put_entry(cache, 123, 'Shingeki no Kyojin', time.time() + 60)
+    put_entry(cache, 456, 'Kimetsu no Yaiba', time.time() + 60)
+    assert cache.find_similar('Kimetsu no Yaibaa', 0.8).id == '456'
+    # Entry expiring after the index was built
+    put_entry(cache, 123, 'Shingeki no Kyojin', time.time() - 1)
+    assert cache.find_similar('Shingeki no Kyojinn', 0.8) is None
+    assert cache.find_similar('Shingeki no Kyojinn', 0.8) is None
+    assert cache.find_similar('Kimetsu no Yaibaa', 0.8).id == '456'
+    assert lookups == []
+    cache.close()
+
+
+def test_fetch_mal_list_parses_entries(monkeypatch):
+    monkeypatch.setattr(mal_cache, 'LIST_CHUNK', 16)
+    entries = fetch_mal_list(Session([Response(200, MAL_LIST)]), 'user')
+    assert [(x.id, x.title, x.episodes) for x in entries] == [
+        ('1', 'Title', '3'), ('2', 'Other', '24')]
+
+
+def test_fetch_mal_list_retries_throttled_requests(monkeypatch):
+    waits = list()
+    monkeypatch.setattr(mal_cache.time, 'sleep', waits.append)
+    session = Session([
+        Response(200, '<html>Too Many Requests</html>'),
+        Response(429, '', {'Retry-After': '5'}),
+        Response(503, ''),
+        Response(200, MAL_LIST)])
+    assert len(fetch_mal_list(session, 'user')) == 2
+    assert session.requests == 4
+    assert waits == [1, 5.0, 4]
+
+
+def test_fetch_mal_list_fails_after_retries(monkeypatch):
+    monkeypatch.setattr(mal_cache.time, 'sleep', lambda wait: None)
+    session = Session(
+        Response(200, '<html>Too Many Requests</html>') for x in range(4))
+    with pytest.raises(requests.HTTPError):
+        fetch_mal_list(session, 'user')
+    assert session.requests == 4
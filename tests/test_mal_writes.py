@@ -0,0 +1,129 @@
+import spice_api as spice
+
+import mal_writes
+from mal_writes import MalWriteQueue
+
+
+class Response:
+    def __init__(self, status_code, text='', headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or dict()
+
+
+class Session:
+    # Answers the writes in order, the last answer is repeated
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.urls = list()
+
+    def get(self, url, **kwargs):
+        self.urls.append(url)
+        if len(self.responses) > 1:
+            return self.responses.pop(0)
+        return self.responses[0]
+
+
+def anime(episodes):
+    data = spice.get_blank(spice.get_medium('anime'))
+    data.episodes = episodes
+    return data
+
+
+def queue(session, retries=3):
+    return MalWriteQueue(('user', 'password'), 0, 1, retries, session)
+
+
+def operations(session):
+    return [url.split('/animelist/')[1].split('/')[0] for url in session.urls]
+
+
+def test_writes_to_one_entry_are_coalesced():
+    session = Session(Response(200, 'Updated'))
+    writes = queue(session)
+    writes.update(anime(3), 10)
+    writes.update(anime(4), 10)
+    writes.update(anime(1), 20)
+    assert writes.flush()
+    assert operations(session) == ['update', 'update']
+    assert '<episode>4</episode>' in session.urls[0]
+    assert writes.updated == 2
+
+
+def test_add_and_update_are_sent_as_add():
+    session = Session(Response(201, 'Created'))
+    writes = queue(session)
+    writes.add(anime(0), 10)
+    writes.update(anime(5), 10)
+    assert writes.flush()
+    assert operations(session) == ['add']
+    assert '<episode>5</episode>' in session.urls[0]
+    assert writes.added == 1
+
+
+def test_rejected_add_is_sent_as_update():
+    session = Session(
+        Response(400, 'The anime (id: 10) is already in the list.'),
+        Response(200, 'Updated'))
+    writes = queue(session)
+    writes.add(anime(5), 10)
+    assert writes.flush()
+    assert operations(session) == ['add', 'update']
+    assert (writes.added, writes.updated, writes.failed) == (0, 1, 0)
+
+
+def test_rejected_update_fails():
+    session = Session(Response(400, 'Invalid ID'))
+    writes = queue(session)
+    writes.update(anime(5), 10)
+    assert not writes.flush()
+    assert operations(session) == ['update']
+    assert writes.failed == 1
+
+
+def test_throttled_write_is_retried(monkeypatch):
+    waits = list()
+    monkeypatch.setattr(mal_writes.time, 'sleep', waits.append)
+    session = Session(
+        Response(429, headers={'Retry-After': '7'}),
+        Response(200, 'Too Many Requests'),
+        Response(503),
+        Response(200, 'Updated'))
+    writes = queue(session)
+    writes.update(anime(5), 10)
+    assert writes.flush()
+    assert len(session.urls) == 4
+    assert waits == [7.0, 2, 4]
+    assert (writes.updated, writes.retried) == (1, 3)
+
+
+def test_write_fails_after_retries(monkeypatch):
+    monkeypatch.setattr(mal_writes.time, 'sleep', lambda seconds: None)
+    session = Session(Response(500))
+    writes = queue(session, retries=2)
+    writes.update(anime(5), 10)
+    assert not writes.flush()
+    assert len(session.urls) == 3
+    assert (writes.failed, writes.retried) == (1, 2)
+
+
+def test_journal_records_sent_writes_only():
+    class Journal:
+        def __init__(self):
+            self.writes = list()
+            self.sent = list()
+
+        def set_write(self, mal_id, operation, *args):
+            self.writes.append((mal_id, operation))
+
+        def set_sent(self, mal_id):
+            self.sent.append(mal_id)
+
+    session = Session(Response(200, 'Updated'), Response(400, 'Invalid ID'))
+    writes = queue(session)
+    writes.journal = Journal()
+    writes.update(anime(5), 10)
+    writes.update(anime(5), 20)
+    writes.flush()
+    assert writes.journal.writes == [(10, 'update'), (20, 'update')]
+    assert writes.journal.sent == [10]
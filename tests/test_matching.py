@@ -0,0 +1,79 @@
+import itertools
+
+from mal_cache import MalEntry
+from matching import MalListIndex, TrigramIndex, count_containing, title_key
+
+
+def test_count_containing_matches_substring_count():
+    titles = ['k on', 'k on k on', 'clannad', 'clannad after story',
+              'nanatsu no taizai', 'taizai', 'on']
+    patterns = titles + ['', 'an', 'no', 'zzz']
+    expected = [sum(1 for text in titles if pattern in text)
+                for pattern in patterns]
+    assert count_containing(patterns, titles) == expected
+
+
+def test_count_containing_counts_a_text_once_per_pattern():
+    assert count_containing(['a', 'aa'], ['aaaa', 'b']) == [1, 1]
+
+
+def test_count_containing_overlapping_patterns():
+    for patterns in itertools.permutations(['a', 'ab', 'b', 'abc']):
+        counts = count_containing(list(patterns), ['abc', 'b', 'xab'])
+        assert dict(zip(patterns, counts)) == {
+            'a': 2, 'ab': 2, 'b': 3, 'abc': 1}
+
+
+def test_title_key_season_spellings():
+    assert title_key('Title 2nd Season') == ('title', '2')
+    assert title_key('Title Season 2') == ('title', '2')
+    assert title_key('Title II') == ('title', '2')
+    assert title_key('Title Second Season') == ('title', '2')
+    assert title_key('Title 1st Season') == ('title', '')
+    assert title_key('Title: The Final Season') == ('title', 'final')
+
+
+def test_title_key_keeps_exclamation_seasons_apart():
+    assert title_key('Title!!') == ('title', '!!')
+    assert title_key('Title!!') != title_key('Title')
+
+
+def test_title_key_ignores_case_and_punctuation():
+    assert title_key('Re:ZERO -Starting Life-') == \
+        title_key('re zero starting life')
+
+
+def test_trigram_index_finds_similar_title():
+    index = TrigramIndex()
+    index.add('Shingeki no Kyojin', 1)
+    index.add('Kimetsu no Yaiba', 2)
+    similarity, item = index.find('Shingeki no Kyojinn', 0.8)
+    assert item == 1
+    assert 0.8 <= similarity < 1
+
+
+def test_trigram_index_threshold():
+    index = TrigramIndex()
+    index.add('Shingeki no Kyojin', 1)
+    assert index.find('Kimetsu no Yaiba', 0.5) == (0, None)
+
+
+def test_trigram_index_keeps_seasons_and_numbers_apart():
+    index = TrigramIndex()
+    index.add('Shingeki no Kyojin', 1)
+    index.add('Shingeki no Kyojin Season 2', 2)
+    index.add('Steins;Gate 0', 3)
+    assert index.find('Shingeki no Kyojin 2nd Season', 0.8)[1] == 2
+    assert index.find('Shingeki no Kyojin 3', 0.1) == (0, None)
+    assert index.find('Steins;Gate', 0.1) == (0, None)
+
+
+def test_mal_list_index_skips_empty_titles():
+    entries = [MalEntry('1', 'Title', None, '1', '1'),
+               MalEntry('2', '', None, '1', '1'),
+               MalEntry('3', 'Other', 'English', '1', '1')]
+    index = MalListIndex(entries)
+    assert index.find_by_title('') == []
+    assert index.find_by_title('!!!') == []
+    assert [x.id for x in index.find_by_title('english')] == ['3']
+    assert [x.id for x in index.find_by_title('TITLE')] == ['1']
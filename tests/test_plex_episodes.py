@@ -0,0 +1,51 @@
+from urllib.parse import parse_qs, urlsplit
+
+import PlexMALSync as sync
+
+ITEMS = list(range(25))
+KEY = '/library/sections/1/all?type=4'
+
+
+class PagedSection:
+    # fetchItems() of plexapi 4, requesting all pages itself
+    def __init__(self):
+        self.calls = list()
+
+    def fetchItems(self, ekey, cls=None, container_start=None,
+                   container_size=None, maxresults=None, **kwargs):
+        self.calls.append((ekey, container_size))
+        return list(ITEMS)
+
+
+class KeyedSection:
+    # fetchItems() of plexapi 3, returning the page the key asks for
+    def __init__(self):
+        self.calls = list()
+
+    def fetchItems(self, ekey, cls=None, **kwargs):
+        self.calls.append(ekey)
+        query = parse_qs(urlsplit(ekey).query)
+        start = int(query['X-Plex-Container-Start'][0])
+        size = int(query['X-Plex-Container-Size'][0])
+        return ITEMS[start:start + size]
+
+
+def test_fetch_pages_lets_plexapi_page():
+    section = PagedSection()
+    pages = list(sync.fetch_pages(section, KEY, 10))
+    assert [x for page in pages for x in page] == ITEMS
+    assert section.calls == [(KEY, 10)]
+
+
+def test_fetch_pages_pages_the_key():
+    section = KeyedSection()
+    pages = list(sync.fetch_pages(section, KEY, 10))
+    assert [x for page in pages for x in page] == ITEMS
+    assert len(section.calls) == 3
+    assert all(call.startswith(KEY + '&') for call in section.calls)
+
+
+def test_fetch_pages_stops_after_full_last_page():
+    section = KeyedSection()
+    pages = list(sync.fetch_pages(section, KEY, 5))
+    assert [len(page) for page in pages] == [5, 5, 5, 5, 5, 0]
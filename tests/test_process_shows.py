@@ -0,0 +1,53 @@
+import logging
+import threading
+import time
+import types
+
+import pytest
+
+import PlexMALSync as sync
+
+
+def get_context(workers):
+    return types.SimpleNamespace(
+        workers=workers, host_limits={'plex': threading.BoundedSemaphore(4)})
+
+
+def process(show):
+    # Later shows finish first when run by workers
+    sync.logger.info('start {}'.format(show))
+    time.sleep(0.01 * (8 - show))
+    if show == 5:
+        raise ValueError('show {}'.format(show))
+    sync.logger.info('done {}'.format(show))
+    return show * 2
+
+
+def run(caplog, workers, shows):
+    caplog.clear()
+    try:
+        result = sync.process_shows(
+            get_context(workers), process, shows, 'plex')
+    except ValueError as e:
+        result = e
+    messages = [record.getMessage() for record in caplog.records
+                if record.name == 'PlexMALSync']
+    return result, messages
+
+
+@pytest.mark.parametrize('shows', [[0, 1, 2, 3], [0, 1, 2, 3, 4, 5, 6, 7]])
+def test_workers_give_the_sequential_results(caplog, shows):
+    caplog.set_level(logging.INFO, logger='PlexMALSync')
+    sequential = run(caplog, 1, shows)
+    parallel = run(caplog, 4, shows)
+    assert parallel[1] == sequential[1]
+    if 5 in shows:
+        assert isinstance(sequential[0], ValueError)
+        assert isinstance(parallel[0], ValueError)
+        assert str(parallel[0]) == str(sequential[0]) == 'show 5'
+        assert sequential[1][-1] == 'start 5'
+    else:
+        assert parallel[0] == sequential[0] == [0, 2, 4, 6]
+        assert sequential[1] == [
+            'start 0', 'done 0', 'start 1', 'done 1',
+            'start 2', 'done 2', 'start 3', 'done 3']
@@ -0,0 +1,37 @@
+import configparser
+import threading
+import time
+
+import mal_writes
+import PlexMALSync as sync
+
+
+class SlowWriteQueue(mal_writes.MalWriteQueue):
+    # Gives other workers time to ask for the queue while it is created
+    def __init__(self, *args, **kwargs):
+        time.sleep(0.05)
+        super().__init__(*args, **kwargs)
+
+
+def test_workers_share_one_write_queue(monkeypatch, tmp_path):
+    monkeypatch.setattr(mal_writes, 'MalWriteQueue', SlowWriteQueue)
+    settings = configparser.ConfigParser()
+    settings.read_dict({
+        'MAL': {'username': 'user', 'password': 'password'},
+        'SYNC': {'state_file': str(tmp_path / 'PlexMALSync.db')}})
+    context = sync.SyncContext(settings)
+    context.verify_credentials = False
+    barrier = threading.Barrier(8)
+    queues = list()
+
+    def worker():
+        barrier.wait()
+        queues.append(context.mal_writes)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(queues) == 8
+    assert all(queue is queues[0] for queue in queues)
@@ -0,0 +1,127 @@
+import pytest
+
+from sync_state import SyncJournal
+
+
+@pytest.fixture
+def journal_file(tmp_path):
+    return str(tmp_path / 'PlexMALSync.db')
+
+
+def match_show(journal, rating_key, watched, writes=(), matches=()):
+    # Like send_watched_to_mal() matching a show on a worker
+    journal.begin_show(rating_key)
+    for mal_id, episodes, status in writes:
+        journal.set_write(mal_id, 'update', episodes, status, 'Show', 'test')
+    for mal_id, episodes, status in matches:
+        journal.set_match(mal_id, episodes, status)
+    journal.end_show('Show {}'.format(rating_key), watched)
+
+
+def test_resume_skips_matched_shows_and_sends_unsent_writes(journal_file):
+    journal = SyncJournal(journal_file)
+    match_show(journal, '1', (3, 1), writes=[(10, 3, 'watching')])
+    match_show(journal, '2', (12, 1), writes=[(20, 12, 'completed')])
+    journal.set_sent(10)
+    journal.close()
+
+    journal = SyncJournal(journal_file)
+    assert journal.get_show('1') == (3, 1)
+    assert journal.get_show('2') == (12, 1)
+    assert journal.get_show('3') is None
+    writes = journal.pending_writes()
+    assert [(x['mal_id'], x['target_episodes'], x['target_status'])
+            for x in writes] == [(20, 12, 'completed')]
+    # Writes of a show matched again are replaced by the new match
+    assert journal.pending_writes({'2'}) == []
+    journal.close()
+
+
+def test_writes_of_unfinished_show_are_not_resumed(journal_file):
+    journal = SyncJournal(journal_file)
+    journal.begin_show('1')
+    journal.set_write(10, 'add', 1, 'watching', 'Show', 'test')
+    journal.close()
+
+    journal = SyncJournal(journal_file)
+    assert journal.get_show('1') is None
+    assert journal.pending_writes() == []
+    journal.close()
+
+
+def test_compact_keeps_only_shows_with_unsent_writes(journal_file):
+    journal = SyncJournal(journal_file)
+    match_show(journal, '1', (3, 1), writes=[(10, 3, 'watching')])
+    match_show(journal, '2', (12, 1), writes=[(20, 12, 'completed')])
+    journal.set_sent(10)
+    journal.compact()
+    assert journal.get_show('1') is None
+    assert journal.get_show('2') == (12, 1)
+    assert [x['mal_id'] for x in journal.pending_writes()] == [20]
+    journal.close()
+
+
+def test_pushed_show_is_skipped_until_it_changes(journal_file):
+    journal = SyncJournal(journal_file)
+    match_show(journal, '1', (3, 1), writes=[(10, 3, 'watching')])
+    journal.set_sent(10)
+    journal.compact()
+    journal.close()
+
+    journal = SyncJournal(journal_file)
+    entries = {10: (3, 'watching')}
+    assert journal.is_pushed('1', (3, 1), entries)
+    assert not journal.is_pushed('1', (4, 1), entries)
+    assert not journal.is_pushed('1', (3, 1), {10: (2, 'watching')})
+    assert not journal.is_pushed('1', (3, 1), {10: (3, 'dropped')})
+    assert not journal.is_pushed('1', (3, 1), dict())
+    journal.close()
+
+
+def test_show_matched_without_write_is_pushed(journal_file):
+    journal = SyncJournal(journal_file)
+    match_show(journal, '1', (3, 1), matches=[(10, 5, 'watching')])
+    journal.compact()
+    journal.close()
+
+    journal = SyncJournal(journal_file)
+    assert journal.is_pushed('1', (3, 1), {10: (5, 'watching')})
+    assert not journal.is_pushed('1', (3, 1), {10: (6, 'watching')})
+    journal.close()
+
+
+def test_sent_write_replaces_matched_state(journal_file):
+    journal = SyncJournal(journal_file)
+    match_show(journal, '1', (12, 1), writes=[(10, 12, 'completed')],
+               matches=[(10, 12, 'watching')])
+    journal.set_sent(10)
+    journal.compact()
+    journal.close()
+
+    journal = SyncJournal(journal_file)
+    assert journal.is_pushed('1', (12, 1), {10: (12, 'completed')})
+    assert not journal.is_pushed('1', (12, 1), {10: (12, 'watching')})
+    journal.close()
+
+
+def test_unmatched_show_is_not_pushed(journal_file):
+    journal = SyncJournal(journal_file)
+    match_show(journal, '1', (3, 1))
+    journal.compact()
+    journal.close()
+
+    journal = SyncJournal(journal_file)
+    assert not journal.is_pushed('1', (3, 1), dict())
+    assert journal.get_show('1') is None
+    journal.close()
+
+
+def test_show_with_unsent_write_is_not_pushed(journal_file):
+    journal = SyncJournal(journal_file)
+    match_show(journal, '1', (3, 1), writes=[(10, 3, 'watching')])
+    journal.compact()
+    journal.close()
+
+    journal = SyncJournal(journal_file)
+    assert not journal.is_pushed('1', (3, 1), {10: (3, 'watching')})
+    journal.close()
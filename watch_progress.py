@@ -0,0 +1,99 @@
+import importlib.util
+
+
+def calculate_watched(episodes):
+    """
+    calculate_watched: (episodes_watched, season_watched) of a show from its (season, episode, watched)
+    tuples in Plex order, the last watched episode unless it did not follow the one watched before it.
+    """
+    season_watched = 1
+    episodes_watched = 0
+    for season, n_episode, is_watched in episodes:
+        if is_watched and n_episode:
+            if (n_episode > episodes_watched and season ==
+                    season_watched) or (season > season_watched):
+                season_watched = season
+                episodes_watched = n_episode
+            else:
+                episodes_watched = 0
+    return episodes_watched, season_watched
+
+
+class EpisodeTable:
+    """
+    EpisodeTable: episodes retrieved in bulk as columns (show, Plex season, season, episode, watched)
+    instead of a list of tuples per show, so the watch progress of all shows is calculated at once with
+    NumPy in calculate_watched(). without NumPy every show is calculated by calculate_watched().
+    NumPy is imported by calculate_watched(), importing this module does not load it.
+    """
+
+    @staticmethod
+    def vectorized():
+        # Whether calculate_watched() can use NumPy, without importing it
+        return importlib.util.find_spec('numpy') is not None
+
+    def __init__(self):
+        self.show_ids = dict()
+        self.shows = list()
+        self.plex_seasons = list()
+        self.seasons = list()
+        self.episodes = list()
+        self.watched = list()
+
+    def __len__(self):
+        return len(self.shows)
+
+    def append(self, show_key, plex_season, season, episode, watched):
+        # plex_season orders the episodes, specials (season 0) first
+        self.shows.append(self.show_ids.setdefault(show_key, len(self.show_ids)))
+        self.plex_seasons.append(plex_season)
+        self.seasons.append(season)
+        self.episodes.append(episode or 0)
+        self.watched.append(bool(watched))
+
+    def keys(self):
+        return self.show_ids.keys()
+
+    def calculate_watched(self):
+        # show key => (episodes_watched, season_watched), shows without a
+        # watched episode may be left out
+        try:
+            import numpy
+        except ImportError:
+            return self._calculate_watched_loop()
+        if not self.shows:
+            return dict()
+        shows = numpy.array(self.shows)
+        episodes = numpy.array(self.episodes)
+        # Ordered like the episode lists of the shows, episodes at the same
+        # position keep the order they were retrieved in
+        ordered = numpy.lexsort((numpy.arange(len(shows)), episodes, numpy.array(self.plex_seasons), shows))
+        watched = numpy.array(self.watched)[ordered] & (episodes[ordered] > 0)
+        ordered = ordered[watched]
+        if not len(ordered):
+            return dict()
+        shows, seasons, episodes = shows[ordered], numpy.array(self.seasons)[ordered], episodes[ordered]
+
+        # Seasons never decrease within a show so, like calculate_watched(), an
+        # episode counts when it is in a later season or after the episode
+        # before it, or when the one before it did not count
+        positions = numpy.arange(len(shows))
+        advanced = numpy.ones(len(shows), dtype=bool)
+        advanced[1:] = (shows[1:] != shows[:-1]) | (seasons[1:] > seasons[:-1]) | (episodes[1:] > episodes[:-1])
+        last_advanced = numpy.maximum.accumulate(numpy.where(advanced, positions, 0))
+        counted = (positions - last_advanced) % 2 == 0
+        last = numpy.ones(len(shows), dtype=bool)
+        last[:-1] = shows[1:] != shows[:-1]
+
+        keys = list(self.show_ids)
+        return {
+            keys[show]: (int(episode), int(season)) for show, episode, season in zip(
+                shows[last].tolist(), numpy.where(counted, episodes, 0)[last].tolist(), seasons[last].tolist())}
+
+    def _calculate_watched_loop(self):
+        rows = sorted(zip(self.shows, self.plex_seasons, self.episodes, range(len(self.shows))))
+        episodes = dict()
+        for show, plex_season, episode, row in rows:
+            episodes.setdefault(show, list()).append((self.seasons[row], episode, self.watched[row]))
+        keys = list(self.show_ids)
+        return {keys[show]: calculate_watched(show_episodes) for show, show_episodes in episodes.items()}